@@ -1,5 +1,7 @@
 # default config can be overriden by OS env vars
 import os
+import tempfile
+from kombu import Queue
 
 # celery config stuff
 
@@ -21,16 +23,61 @@ result_serializer = "json"
 # Use UTC instead of localtime
 enable_utc = True
 
+# captures are routed by urgency, chunks about to leave the origin's /archive
+# window first, then chunks near the live edge, then older backfill, so
+# separate worker pools can be dedicated to each with -Q
+task_default_queue = "celery"
+task_queues = (
+    Queue("celery"),
+    Queue("capture_expiring"),
+    Queue("capture_live"),
+    Queue("capture_backfill"),
+)
+
+# don't let a worker reserve a backlog of captures ahead of more urgent ones
+worker_prefetch_multiplier = 1
+
+# Seconds between master scheduler runs
+if "SCHEDULER_INTERVAL" in os.environ:
+    SCHEDULER_INTERVAL = int(os.environ["SCHEDULER_INTERVAL"])
+else:
+    SCHEDULER_INTERVAL = 60
+
+# Spread channel checks over the scheduler interval instead of starting them
+# all at once
+if "SCHEDULER_STAGGER" in os.environ:
+    SCHEDULER_STAGGER = os.environ["SCHEDULER_STAGGER"].lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+else:
+    SCHEDULER_STAGGER = False
+
+# Split channels between multiple beat instances, each beat should get the
+# same SCHEDULER_SHARDS and its own SCHEDULER_SHARD from 0 to SHARDS - 1
+if "SCHEDULER_SHARDS" in os.environ:
+    SCHEDULER_SHARDS = int(os.environ["SCHEDULER_SHARDS"])
+else:
+    SCHEDULER_SHARDS = 1
+
+if "SCHEDULER_SHARD" in os.environ:
+    SCHEDULER_SHARD = int(os.environ["SCHEDULER_SHARD"])
+else:
+    SCHEDULER_SHARD = 0
+
 # celery periodic tasks
 beat_schedule = {
     "master-every-min": {
         "task": "archiver.tasks.scheduler.master_scheduler",
-        "schedule": 60,
+        "schedule": SCHEDULER_INTERVAL,
+        "args": (SCHEDULER_SHARD, SCHEDULER_SHARDS),
         "options": {"expires": 5},
     },
     "archive-maintenance-daily": {
         "task": "archiver.tasks.scheduler.archive_maintenance",
         "schedule": 86400,
+        "args": (SCHEDULER_SHARD, SCHEDULER_SHARDS),
     },
 }
 
@@ -42,13 +89,190 @@ if "CAPTURE_LOGLEVEL" in os.environ:
 else:
     CAPTURE_LOGLEVEL = "3"
 
+# Capture logs are stored compressed for a day, logs over this many bytes only
+# keep their head and tail
+if "CAPTURE_LOG_MAX_BYTES" in os.environ:
+    CAPTURE_LOG_MAX_BYTES = int(os.environ["CAPTURE_LOG_MAX_BYTES"])
+else:
+    CAPTURE_LOG_MAX_BYTES = 256 * 1024
+
+# Also store the full capture log gzipped beside the chunk in S3
+if "CAPTURE_LOG_SPILL" in os.environ:
+    CAPTURE_LOG_SPILL = os.environ["CAPTURE_LOG_SPILL"].lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+else:
+    CAPTURE_LOG_SPILL = False
+
 # Capture timeout in seconds, kill any captures taking longer than this
 if "CAPTURE_TIMEOUT" in os.environ:
     CAPTURE_TIMEOUT = int(os.environ["CAPTURE_TIMEOUT"])
 else:
     CAPTURE_TIMEOUT = 300
 
+# Seconds a capture's claim on a chunk lasts without being renewed, a running
+# capture renews it continuously so this only bounds how long a chunk stays
+# blocked after a worker dies
+if "CHUNK_LEASE_TTL" in os.environ:
+    CHUNK_LEASE_TTL = int(os.environ["CHUNK_LEASE_TTL"])
+else:
+    CHUNK_LEASE_TTL = 60
+
+# Upload capture output to S3 while Unified Capture is still writing it,
+# through a named pipe, instead of uploading the file after the capture
+# finished. Requires the capture output to be written sequentially
+if "CAPTURE_STREAMING_UPLOAD" in os.environ:
+    CAPTURE_STREAMING_UPLOAD = os.environ[
+        "CAPTURE_STREAMING_UPLOAD"
+    ].lower() in ("1", "true", "yes")
+else:
+    CAPTURE_STREAMING_UPLOAD = False
+
+# Multipart upload part size in bytes, minimum 5 MiB, and number of parts
+# uploaded in parallel. Can be overridden per channel with the s3_part_size
+# and s3_parallel_uploads channel config fields
+if "S3_PART_SIZE" in os.environ:
+    S3_PART_SIZE = int(os.environ["S3_PART_SIZE"])
+else:
+    S3_PART_SIZE = 16 * 1024 * 1024
+
+if "S3_PARALLEL_UPLOADS" in os.environ:
+    S3_PARALLEL_UPLOADS = int(os.environ["S3_PARALLEL_UPLOADS"])
+else:
+    S3_PARALLEL_UPLOADS = 4
+
+# Number of times a failed S3 request, e.g. a single part upload, is retried
+if "S3_RETRIES" in os.environ:
+    S3_RETRIES = int(os.environ["S3_RETRIES"])
+else:
+    S3_RETRIES = 5
+
+# How captures are run, "subprocess" blocks a worker slot per capture,
+# "asyncio" supervises captures on an event loop so a single worker process
+# can run many, use with the threads pool e.g.
+# celery -A archiver.celery worker --pool threads --concurrency 32
+if "CAPTURE_EXECUTION" in os.environ:
+    CAPTURE_EXECUTION = os.environ["CAPTURE_EXECUTION"]
+else:
+    CAPTURE_EXECUTION = "subprocess"
+
+# Maximum number of captures a worker process supervises at once in asyncio
+# mode, 0 to derive it from CAPTURE_PER_CPU times the number of CPUs, further
+# capped by CAPTURE_NETWORK_BUDGET divided by CAPTURE_BITRATE (bits/s) if a
+# network budget is set
+if "CAPTURE_MAX_CONCURRENT" in os.environ:
+    CAPTURE_MAX_CONCURRENT = int(os.environ["CAPTURE_MAX_CONCURRENT"])
+else:
+    CAPTURE_MAX_CONCURRENT = 0
+
+if "CAPTURE_PER_CPU" in os.environ:
+    CAPTURE_PER_CPU = int(os.environ["CAPTURE_PER_CPU"])
+else:
+    CAPTURE_PER_CPU = 4
+
+if "CAPTURE_NETWORK_BUDGET" in os.environ:
+    CAPTURE_NETWORK_BUDGET = int(os.environ["CAPTURE_NETWORK_BUDGET"])
+else:
+    CAPTURE_NETWORK_BUDGET = 0
+
+# Expected bitrate of a capture in bits/s
+if "CAPTURE_BITRATE" in os.environ:
+    CAPTURE_BITRATE = int(os.environ["CAPTURE_BITRATE"])
+else:
+    CAPTURE_BITRATE = 10000000
+
+# Directory captures are written to before upload, e.g. a tmpfs or local
+# NVMe mount. Captures only start when it has room for their expected size,
+# CAPTURE_BITRATE times chunk duration times CAPTURE_SCRATCH_HEADROOM, while
+# keeping CAPTURE_SCRATCH_MIN_FREE bytes free, otherwise they are deferred for
+# CAPTURE_DEFER_DELAY seconds
+if "CAPTURE_SCRATCH_DIR" in os.environ:
+    CAPTURE_SCRATCH_DIR = os.environ["CAPTURE_SCRATCH_DIR"]
+else:
+    CAPTURE_SCRATCH_DIR = os.path.join(tempfile.gettempdir(), "archiver")
+
+if "CAPTURE_SCRATCH_HEADROOM" in os.environ:
+    CAPTURE_SCRATCH_HEADROOM = float(os.environ["CAPTURE_SCRATCH_HEADROOM"])
+else:
+    CAPTURE_SCRATCH_HEADROOM = 1.25
+
+if "CAPTURE_SCRATCH_MIN_FREE" in os.environ:
+    CAPTURE_SCRATCH_MIN_FREE = int(os.environ["CAPTURE_SCRATCH_MIN_FREE"])
+else:
+    CAPTURE_SCRATCH_MIN_FREE = 64 * 1024 * 1024
+
+# Maximum number of captures running at once against a single origin host,
+# and for a single channel, 0 for no limit. Captures over the limit are
+# deferred and retried after CAPTURE_DEFER_DELAY seconds
+if "ORIGIN_CAPTURE_LIMIT" in os.environ:
+    ORIGIN_CAPTURE_LIMIT = int(os.environ["ORIGIN_CAPTURE_LIMIT"])
+else:
+    ORIGIN_CAPTURE_LIMIT = 8
+
+if "CHANNEL_CAPTURE_LIMIT" in os.environ:
+    CHANNEL_CAPTURE_LIMIT = int(os.environ["CHANNEL_CAPTURE_LIMIT"])
+else:
+    CHANNEL_CAPTURE_LIMIT = 2
+
+if "CAPTURE_DEFER_DELAY" in os.environ:
+    CAPTURE_DEFER_DELAY = int(os.environ["CAPTURE_DEFER_DELAY"])
+else:
+    CAPTURE_DEFER_DELAY = 30
+
+# Seconds between full reconciliations of a channel's /archive against the
+# permanent archive, in between only newly completed chunks and known gaps are
+# checked
+if "SCHEDULER_RECONCILE_INTERVAL" in os.environ:
+    SCHEDULER_RECONCILE_INTERVAL = int(
+        os.environ["SCHEDULER_RECONCILE_INTERVAL"]
+    )
+else:
+    SCHEDULER_RECONCILE_INTERVAL = 3600
+
+# Captures of chunks which will leave the origin's /archive window within this
+# many seconds go to the capture_expiring queue
+if "CAPTURE_EXPIRING_WINDOW" in os.environ:
+    CAPTURE_EXPIRING_WINDOW = int(os.environ["CAPTURE_EXPIRING_WINDOW"])
+else:
+    CAPTURE_EXPIRING_WINDOW = 3600
+
+# Captures of chunks ending within this many seconds of the live edge go to
+# the capture_live queue, anything else to capture_backfill
+if "CAPTURE_LIVE_WINDOW" in os.environ:
+    CAPTURE_LIVE_WINDOW = int(os.environ["CAPTURE_LIVE_WINDOW"])
+else:
+    CAPTURE_LIVE_WINDOW = 600
+
+# Schedule the capture of each next chunk to start just after the chunk
+# completes, instead of waiting for the scheduler to notice it. The scheduler
+# still fills any gaps, so SCHEDULER_INTERVAL can be raised when enabled
+if "CAPTURE_PREDICTIVE" in os.environ:
+    CAPTURE_PREDICTIVE = os.environ["CAPTURE_PREDICTIVE"].lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+else:
+    CAPTURE_PREDICTIVE = False
+
+# Seconds after a chunk's end to start a predicted capture, to allow for the
+# origin to finish ingesting it
+if "CAPTURE_ETA_MARGIN" in os.environ:
+    CAPTURE_ETA_MARGIN = int(os.environ["CAPTURE_ETA_MARGIN"])
+else:
+    CAPTURE_ETA_MARGIN = 10
+
 if "REMIX_URL" in os.environ:
     REMIX_URL = os.environ["REMIX_URL"]
 else:
     REMIX_URL = "http://remix-proxy"
+
+# Port workers serve Prometheus metrics on, 0 to disable. With the prefork
+# pool PROMETHEUS_MULTIPROC_DIR must also be set, so metrics of all pool
+# processes are collected
+if "WORKER_METRICS_PORT" in os.environ:
+    WORKER_METRICS_PORT = int(os.environ["WORKER_METRICS_PORT"])
+else:
+    WORKER_METRICS_PORT = 9540
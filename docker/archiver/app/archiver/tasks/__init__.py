@@ -5,3 +5,35 @@ import automodinit
 automodinit.automodinit(__name__, __file__, globals())
 del automodinit
 # Anything else you want can go after here, it won't get modified.
+from archiver import app
+from archiver.utils import metrics
+from celery.concurrency import get_implementation
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.signals import worker_init, worker_process_shutdown
+from celery.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+
+@worker_init.connect
+def start_metrics_exporter(sender=None, **kwargs):
+    if app.config["WORKER_METRICS_PORT"] <= 0:
+        return
+
+    # prefork pool processes record metrics in their own registries, which
+    # are only collected in multiprocess mode
+    if not metrics.multiprocess_mode() and issubclass(
+        get_implementation(sender.pool_cls), PreforkPool
+    ):
+        logger.warning(
+            "not serving worker metrics, the prefork pool needs "
+            "PROMETHEUS_MULTIPROC_DIR set"
+        )
+        return
+
+    metrics.start_exporter(app.config["WORKER_METRICS_PORT"])
+
+
+@worker_process_shutdown.connect
+def mark_metrics_process_dead(pid=None, **kwargs):
+    metrics.process_dead(pid)
@@ -13,6 +13,17 @@ logger = get_task_logger(__name__)
 EPOCH = datetime(1970, 1, 1, tzinfo=isodate.tzinfo.UTC)
 
 
+def checksum_matches(checksum, listed):
+    """
+    compare checksum recorded at upload with size and ETag listed by S3
+    """
+    if checksum.get("size") != listed["size"]:
+        return False
+    if checksum.get("etag") and listed["etag"]:
+        return checksum["etag"].strip('"') == listed["etag"].strip('"')
+    return True
+
+
 @celery.task
 def verify_archive(channel_name):
     channel = state.get_channel(channel_name)
@@ -37,7 +48,11 @@ def verify_archive(channel_name):
         start_interval = (start - EPOCH) // interval
         end_interval = (now - EPOCH) // interval
 
-        archive_chunks = channel_archive.list_chunks_between(start, now)
+        # sizes and ETags from the listing, compared with the checksums
+        # recorded at upload so media never has to be downloaded again
+        archive_chunks = channel_archive.list_chunk_objects_between(start, now)
+        checksums = state.get_chunk_checksums(channel_name)
+        corrupt_chunks = []
 
         for i in range(start_interval, end_interval):
             chunk_start = EPOCH + (i * interval)
@@ -54,14 +69,38 @@ def verify_archive(channel_name):
             chunk_in_archive = chunk in archive_chunks
 
             logger.info(f"in archive: {chunk_in_archive}")
-            if chunk_in_archive:
+            if not chunk_in_archive:
+                # mark missing
+                state.mark_chunk_missing(channel_name, chunk)
+            elif chunk in checksums and not checksum_matches(
+                checksums[chunk], archive_chunks[chunk]
+            ):
+                logger.error(
+                    f"chunk does not match its upload checksum: {chunk}"
+                )
+                corrupt_chunks.append(chunk)
+            else:
                 # mark complete
                 state.mark_chunk_complete(
                     channel_name, chunk_start.timestamp(), chunk
                 )
-            else:
-                # mark missing
-                state.mark_chunk_missing(channel_name, chunk)
+
+        if corrupt_chunks:
+            # deleted chunks are gaps again and get recaptured, ones which
+            # failed to delete keep their checksum to be retried next time
+            errors = channel_archive.delete_chunks(corrupt_chunks)
+            for chunk in corrupt_chunks:
+                state.mark_chunk_missing(
+                    channel_name,
+                    chunk,
+                    forget_checksum=chunk not in errors,
+                )
+            for name, error in errors.items():
+                logger.error(f"failed to delete {name}: {error}")
+
+            return "verified channel {0} archive, {1} corrupt chunks".format(
+                channel_name, len(corrupt_chunks)
+            )
 
         return "verified channel {0} archive".format(channel_name)
 
@@ -81,21 +120,39 @@ def cleanup_archive(channel_name):
         )
 
         # get all chunks older than the channel archive_length
-        chunks_to_delete = state.get_complete_chunks(
-            "scte35",
-            0,
-            (
-                datetime.now()
-                - isodate.parse_duration(channel["archive_length"])
-            ).timestamp(),
+        expiry = (
+            datetime.now() - isodate.parse_duration(channel["archive_length"])
+        ).timestamp()
+        chunks_to_delete = state.get_complete_chunks(channel_name, 0, expiry)
+
+        logger.info(
+            f"deleting {len(chunks_to_delete)} chunks "
+            f"of channel: {channel_name}"
         )
+        errors = channel_archive.delete_chunks(chunks_to_delete)
 
-        for chunk in chunks_to_delete:
-            logger.info(f"deleting chunk: {chunk}")
-            channel_archive.delete_chunk(chunk)
-            state.mark_chunk_missing(channel_name, chunk)
-            logger.info(f"deleted chunk: {chunk}")
+        for name, error in errors.items():
+            logger.error(f"failed to delete {name}: {error}")
+
+        # chunks which failed to delete stay marked complete to be retried,
+        # chunks completed since they were listed are left alone
+        deleted = state.remove_chunks(
+            channel_name,
+            [
+                chunk
+                for chunk in chunks_to_delete
+                if chunk not in errors and f"{chunk}.log.gz" not in errors
+            ],
+        )
+
+        if errors:
+            return (
+                "cleaned channel {0} archive, deleting {1} chunks, "
+                "{2} objects failed: {3}".format(
+                    channel_name, deleted, len(errors), errors
+                )
+            )
 
         return "cleaned channel {0} archive, deleting {1} chunks".format(
-            channel_name, len(chunks_to_delete)
+            channel_name, deleted
         )
@@ -1,11 +1,25 @@
 from __future__ import absolute_import, unicode_literals
 from archiver import app, celery, state
+import collections
 import subprocess
-import tempfile
+import threading
+import time
 import os
 import isodate
-from archiver.utils.archive import Archive
-from datetime import datetime
+from urllib.parse import urlparse
+from archiver.utils.archive import Archive, chunk_name
+from archiver.utils.metrics import (
+    CAPTURES,
+    CAPTURE_QUEUE_WAIT_SECONDS,
+    CAPTURE_STAGE_SECONDS,
+)
+from archiver.utils.scratch import ScratchSpace
+from archiver.utils.state_backend import truncation_marker
+from archiver.utils.supervisor import CaptureSupervisor, concurrency_limit
+from datetime import datetime, timedelta
+from redis import RedisError
+from uuid import uuid4
+from celery.signals import worker_init, worker_shutdown
 from celery.utils.log import get_task_logger
 
 
@@ -13,47 +27,486 @@ logger = get_task_logger(__name__)
 
 CAPTURE_LOGLEVEL = app.config["CAPTURE_LOGLEVEL"]
 CAPTURE_TIMEOUT = app.config["CAPTURE_TIMEOUT"]
+CHUNK_LEASE_TTL = app.config["CHUNK_LEASE_TTL"]
+CAPTURE_PREDICTIVE = app.config["CAPTURE_PREDICTIVE"]
+CAPTURE_ETA_MARGIN = app.config["CAPTURE_ETA_MARGIN"]
+# workers hold tasks with an ETA unacknowledged, which RabbitMQ only allows
+# for its consumer_timeout (30 minutes by default), later ones are left to
+# one of the next scheduler ticks
+CAPTURE_ETA_MAX_AHEAD = min(3 * app.config["SCHEDULER_INTERVAL"], 20 * 60)
+ORIGIN_CAPTURE_LIMIT = app.config["ORIGIN_CAPTURE_LIMIT"]
+CHANNEL_CAPTURE_LIMIT = app.config["CHANNEL_CAPTURE_LIMIT"]
+CAPTURE_DEFER_DELAY = app.config["CAPTURE_DEFER_DELAY"]
+CAPTURE_STREAMING_UPLOAD = app.config["CAPTURE_STREAMING_UPLOAD"]
+S3_PART_SIZE = app.config["S3_PART_SIZE"]
+S3_PARALLEL_UPLOADS = app.config["S3_PARALLEL_UPLOADS"]
+S3_RETRIES = app.config["S3_RETRIES"]
+CAPTURE_EXECUTION = app.config["CAPTURE_EXECUTION"]
+CAPTURE_LOG_MAX_BYTES = app.config["CAPTURE_LOG_MAX_BYTES"]
+CAPTURE_LOG_SPILL = app.config["CAPTURE_LOG_SPILL"]
+CAPTURE_BITRATE = app.config["CAPTURE_BITRATE"]
+CAPTURE_SCRATCH_HEADROOM = app.config["CAPTURE_SCRATCH_HEADROOM"]
 
+# how often capture logs are appended to their live redis stream
+CAPTURE_LOG_FLUSH_BYTES = 16 * 1024
+CAPTURE_LOG_FLUSH_INTERVAL = 1
 
-@celery.task
-def capture(job):
-    # mark chunk as in progress
-    job_start_time = datetime.utcnow()
-    job["start_time"] = job_start_time.isoformat()
-    job["start_timestamp"] = job_start_time.timestamp()
+if app.config["CAPTURE_MAX_CONCURRENT"] > 0:
+    CAPTURE_MAX_CONCURRENT = app.config["CAPTURE_MAX_CONCURRENT"]
+else:
+    CAPTURE_MAX_CONCURRENT = concurrency_limit(
+        app.config["CAPTURE_PER_CPU"],
+        app.config["CAPTURE_NETWORK_BUDGET"],
+        app.config["CAPTURE_BITRATE"],
+    )
+
+# runs captures in asyncio execution mode
+supervisor = CaptureSupervisor(CAPTURE_MAX_CONCURRENT)
+
+scratch = ScratchSpace(
+    app.config["CAPTURE_SCRATCH_DIR"], app.config["CAPTURE_SCRATCH_MIN_FREE"]
+)
+
+
+@worker_init.connect
+def sweep_scratch(**kwargs):
+    for path in scratch.sweep():
+        logger.warning(f"removed orphaned capture directory: {path}")
+
+
+@worker_shutdown.connect
+def stop_captures(**kwargs):
+    supervisor.cancel_all()
+
+
+class ClaimRenewer(threading.Thread):
+    """
+    Keep renewing a chunk claim and capture slots in the background while a
+    capture runs, so they only expire if the worker dies
+    """
+
+    def __init__(self, chunk, owner, ttl, slots=()):
+        super().__init__(daemon=True)
+        self.chunk = chunk
+        self.owner = owner
+        self.ttl = ttl
+        self.slots = list(slots)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.ttl / 3):
+            if self.slots:
+                state.renew_capture_slots(self.owner, self.slots, self.ttl)
+            if not state.renew_chunk_claim(self.chunk, self.owner, self.ttl):
+                logger.warning(f"lost claim on chunk: {self.chunk}")
+                return
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.join()
+
+
+def new_job(channel, config, start, end, queue):
+    """
+    create capture job for a channel's chunk
+    """
+    return {
+        "id": uuid4(),
+        "channel_name": channel,
+        "channel_url": config["channel_url"],
+        "start": start,
+        "end": end,
+        "s3_endpoint": config["s3_endpoint"],
+        "s3_access_key": config["s3_access_key"],
+        "s3_secret_key": config["s3_secret_key"],
+        "s3_bucket": config["s3_bucket"],
+        "secure": config["secure"],
+        "s3_part_size": config.get("s3_part_size", S3_PART_SIZE),
+        "s3_parallel_uploads": config.get(
+            "s3_parallel_uploads", S3_PARALLEL_UPLOADS
+        ),
+        "stages": {},
+        "queue": queue,
+        "queued_timestamp": time.time(),
+    }
+
+
+def schedule_predicted_capture(channel, config, start):
+    """
+    schedule capture of the chunk starting at start to run just after its
+    predicted completion, unless one is already scheduled, it should
+    already be complete, which is left to the gap check, or it is more than
+    CAPTURE_ETA_MAX_AHEAD away, which is left to a later scheduler tick
+    """
+    end = start + isodate.parse_duration(config["chunk_duration"])
+    eta = end + timedelta(seconds=CAPTURE_ETA_MARGIN)
+
+    now = datetime.now(isodate.UTC)
+    if eta <= now or (eta - now).total_seconds() > CAPTURE_ETA_MAX_AHEAD:
+        return None
+
+    # keep marker until the capture has had time to claim the chunk
+    ttl = int((eta - now).total_seconds())
+    if not state.mark_chunk_scheduled(
+        chunk_name(channel, start, end), ttl + CHUNK_LEASE_TTL
+    ):
+        return None
+
+    job = new_job(channel, config, start, end, "capture_live")
+    job["predicted"] = True
+    job["queued_timestamp"] = eta.timestamp()
+
+    logger.info(f"scheduling predicted capture at {eta} for job {job}")
+    return capture.s(job).apply_async(queue=job["queue"], eta=eta)
+
+
+def capture_slot_limits(job):
+    """
+    admission control semaphores a capture job needs a slot in, as a dict of
+    slot key to limit
+    """
+    limits = {}
+    if ORIGIN_CAPTURE_LIMIT > 0:
+        origin = urlparse(job["channel_url"]).netloc
+        limits[state.capture_slot_key("origin", origin)] = ORIGIN_CAPTURE_LIMIT
+    if CHANNEL_CAPTURE_LIMIT > 0:
+        limits[
+            state.capture_slot_key("channel", job["channel_name"])
+        ] = CHANNEL_CAPTURE_LIMIT
+    return limits
+
+
+def expected_capture_size(job):
+    """
+    bytes of scratch space a capture job is expected to need
+    """
+    if CAPTURE_STREAMING_UPLOAD:
+        # output goes straight to S3, only the log may be written
+        return CAPTURE_LOG_MAX_BYTES if CAPTURE_LOG_SPILL else 0
+
+    duration = (job["end"] - job["start"]).total_seconds()
+    return int(CAPTURE_BITRATE / 8 * duration * CAPTURE_SCRATCH_HEADROOM)
 
-    job["stages"]["mark_chunk_in_progress"] = "starting"
+
+def defer_capture(task, job, stage, claim_owner, slot_limits=None):
+    """
+    give back the chunk and any capture slots and retry the capture after
+    CAPTURE_DEFER_DELAY
+    """
+    job["stages"][stage] = "deferred"
+    job["queued_timestamp"] = time.time() + CAPTURE_DEFER_DELAY
     state.set_job_state(job)
+    CAPTURES.labels("deferred").inc()
 
-    date = job["start"].strftime("%Y-%m-%d")
-    chunk = "{0}/{1}/{2}--{3}.ismv".format(
-        job["channel_name"], date, job["start"].isoformat().replace("+00:00", "Z"), job["end"].isoformat().replace("+00:00", "Z")
+    # keep the scheduler from queueing the chunk again meanwhile
+    state.mark_chunk_scheduled(
+        job["chunk"], CAPTURE_DEFER_DELAY + CHUNK_LEASE_TTL
     )
+    if slot_limits:
+        state.release_capture_slots(claim_owner, slot_limits)
+    state.release_chunk_claim(job["chunk"], claim_owner)
+    return task.retry(countdown=CAPTURE_DEFER_DELAY, max_retries=None)
+
+
+@celery.task(bind=True)
+def capture(self, job):
+    # claim chunk
+    job["start_timestamp"] = time.time()
+
+    if "queued_timestamp" in job:
+        CAPTURE_QUEUE_WAIT_SECONDS.labels(job.get("queue", "celery")).observe(
+            max(time.time() - job["queued_timestamp"], 0)
+        )
+
+    job["stages"]["claim_chunk"] = "starting"
+    state.set_job_state(job)
+
+    chunk = chunk_name(job["channel_name"], job["start"], job["end"])
     job["chunk"] = chunk
 
-    chunk_in_progress = state.check_chunk_in_progress(chunk)
+    claim_owner = str(job["id"])
+    chunk_claimed = state.claim_chunk(chunk, claim_owner, CHUNK_LEASE_TTL)
 
-    logger.info("{0} in_progress: {1}".format(chunk, chunk_in_progress))
+    logger.info("{0} claimed: {1}".format(chunk, chunk_claimed))
 
-    if chunk_in_progress:
-        job["stages"]["mark_chunk_in_progress"] = "rejected"
+    if not chunk_claimed:
+        job["stages"]["claim_chunk"] = "rejected"
         state.set_job_state(job)
+        CAPTURES.labels("rejected").inc()
         raise Exception("chunk already in progress")
 
-    state.mark_chunk_in_progress(chunk)
+    job["stages"]["claim_chunk"] = "done"
+
+    # limit concurrent captures per origin and channel
+    slot_limits = capture_slot_limits(job)
+    if not state.acquire_capture_slots(
+        claim_owner, slot_limits, CHUNK_LEASE_TTL
+    ):
+        logger.info(f"{chunk} over capture limit, deferring")
+        raise defer_capture(self, job, "admission", claim_owner)
+
+    job["stages"]["admission"] = "done"
+
+    # reserve room for the capture before starting it
+    reservation = scratch.reserve(expected_capture_size(job))
+    if reservation is None:
+        logger.info(f"{chunk} not enough scratch space, deferring")
+        raise defer_capture(self, job, "scratch", claim_owner, slot_limits)
+
+    job["stages"]["scratch"] = "done"
+
+    try:
+        with ClaimRenewer(
+            chunk, claim_owner, CHUNK_LEASE_TTL, slots=slot_limits
+        ):
+            capture_and_upload(job, reservation.path)
+    except Exception:
+        CAPTURES.labels("error").inc()
+        # complete the job as failed, so it is indexed as failed
+        for stage, status in job["stages"].items():
+            if status == "starting":
+                job["stages"][stage] = "failed"
+        job["complete_timestamp"] = time.time()
+        state.set_job_state(job)
+        raise
+    finally:
+        # release chunk, slots and scratch space, also when the capture raised
+        job["stages"]["release_chunk"] = "starting"
+        state.set_job_stages(job)
+        reservation.release()
+        state.release_capture_slots(claim_owner, slot_limits)
+        state.release_chunk_claim(job["chunk"], claim_owner)
+        job["stages"]["release_chunk"] = "done"
+
+    job["complete_timestamp"] = time.time()
+
+    state.set_job_state(job)
+    CAPTURES.labels(
+        "done" if job["stages"].get("s3_put") == "done" else "failed"
+    ).inc()
+
+    # chain on to the next chunk, if this failed the scheduler will take over
+    if (
+        CAPTURE_PREDICTIVE
+        and job.get("predicted")
+        and job["stages"].get("s3_put") == "done"
+    ):
+        config = state.get_channel(job["channel_name"])
+        if config is not None:
+            schedule_predicted_capture(job["channel_name"], config, job["end"])
+
+    return job
+
+
+class CaptureFailed(Exception):
+    pass
+
+
+class CaptureStream(object):
+    """
+    File-like reader over Unified Capture's output pipe, raises at the end of
+    the stream if the capture failed so a partial upload gets aborted
+    """
+
+    def __init__(self, pipe, result):
+        self.pipe = pipe
+        self.result = result
 
-    job["stages"]["mark_chunk_in_progress"] = "done"
+    def read(self, size=-1):
+        data = self.pipe.read(size)
+        if not data and self.result.get("returncode") != 0:
+            raise CaptureFailed(
+                "capture failed with returncode {0}".format(
+                    self.result.get("returncode")
+                )
+            )
+        return data
 
+
+def next_stream_id(entry_id):
+    """
+    smallest redis stream id after entry_id
+    """
+    milliseconds, sequence = str(entry_id, "ascii").split("-")
+    return "{0}-{1}".format(milliseconds, int(sequence) + 1)
+
+
+class CaptureLog(object):
+    """
+    Collects Unified Capture's stderr while it runs, appending it to a redis
+    stream for live viewing and optionally a spill file, while only keeping
+    its head and tail in memory and about max_bytes of its tail in the stream
+    """
+
+    def __init__(self, job_id, max_bytes, spill_path=None):
+        self.job_id = job_id
+        self.max_bytes = max_bytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.size = 0
+        self.pending = []
+        self.pending_size = 0
+        self.last_flush = time.monotonic()
+        self.streamed = collections.deque()
+        self.streamed_size = 0
+        self.spill_path = spill_path
+        self.spill = open(spill_path, "wb") if spill_path else None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.spill is not None:
+            self.spill.write(data)
+
+        room = self.max_bytes // 2 - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+        self.tail += data[max(room, 0) :]
+        del self.tail[: max(len(self.tail) - self.max_bytes // 2, 0)]
+
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if (
+            self.pending_size >= CAPTURE_LOG_FLUSH_BYTES
+            or time.monotonic() - self.last_flush >= CAPTURE_LOG_FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def flush(self, eof=False):
+        # drop the oldest streamed pieces which don't fit next to this one
+        dropped = 0
+        streamed_size = self.streamed_size
+        while dropped < len(self.streamed) and (
+            streamed_size + self.pending_size > self.max_bytes
+        ):
+            streamed_size -= self.streamed[dropped][1]
+            dropped += 1
+        min_id = None
+        if dropped:
+            min_id = next_stream_id(self.streamed[dropped - 1][0])
+
+        # the live log is best effort, it must never fail the capture
+        try:
+            entry_id = state.append_capture_log_stream(
+                self.job_id, b"".join(self.pending), eof, min_id
+            )
+        except RedisError:
+            logger.exception(
+                "failed to stream capture log of job {0}".format(self.job_id)
+            )
+        else:
+            for _ in range(dropped):
+                self.streamed.popleft()
+            self.streamed_size = streamed_size
+            if entry_id is not None:
+                self.streamed.append((entry_id, self.pending_size))
+                self.streamed_size += self.pending_size
+
+        self.pending = []
+        self.pending_size = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush(eof=True)
+        if self.spill is not None:
+            self.spill.close()
+
+    def getvalue(self):
+        """
+        head and tail of the log, with a marker if anything was dropped
+        """
+        truncated = self.size - len(self.head) - len(self.tail)
+        if truncated:
+            return bytes(self.head) + truncation_marker(truncated) + self.tail
+        return bytes(self.head + self.tail)
+
+
+def run_capture_process(key, capture_cmd, capture_log):
+    """
+    run Unified Capture to completion, killing it after CAPTURE_TIMEOUT,
+    stderr is written to capture_log as it is produced, returns returncode
+    """
+    if CAPTURE_EXECUTION == "asyncio":
+        return supervisor.run(
+            key, capture_cmd, CAPTURE_TIMEOUT, capture_log.write
+        )
+
+    process = subprocess.Popen(
+        capture_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    killer = threading.Timer(CAPTURE_TIMEOUT, process.kill)
+    killer.start()
+    try:
+        with process.stderr:
+            for data in iter(lambda: process.stderr.read1(65536), b""):
+                capture_log.write(data)
+        return process.wait()
+    finally:
+        killer.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def stream_capture(key, capture_cmd, capture_log, fifo_path, upload):
+    """
+    run Unified Capture writing to a named pipe at fifo_path, while calling
+    upload with a reader of the pipe, returns returncode
+    """
+    os.mkfifo(fifo_path)
+
+    # open both ends ourselves so neither side can block on open, the reader
+    # only sees end of stream once our write end is closed after the capture
+    # process exited
+    read_fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+    keep_fd = os.open(fifo_path, os.O_WRONLY)
+    os.set_blocking(read_fd, True)
+
+    result = {}
+
+    def wait_for_capture():
+        try:
+            result["returncode"] = run_capture_process(
+                key, capture_cmd, capture_log
+            )
+        except Exception as e:
+            result["error"] = e
+        finally:
+            os.close(keep_fd)
+
+    watcher = threading.Thread(target=wait_for_capture, daemon=True)
+    watcher.start()
+
+    try:
+        with open(read_fd, "rb") as pipe:
+            upload(CaptureStream(pipe, result))
+    finally:
+        # capture gets SIGPIPE if the upload stopped early
+        watcher.join()
+
+    if "error" in result:
+        raise result["error"]
+
+    return result["returncode"]
+
+
+def capture_and_upload(job, capture_path):
+    """
+    run Unified Capture for the job's chunk into capture_path and upload the
+    result to S3
+    """
     # start capture
     job["stages"]["capture"] = "starting"
-    state.set_job_state(job)
+    state.set_job_stages(job)
 
     meta_filter = 'filter=(type!="meta")'
     capture_url = "{0}/.mpd?vbegin={1}&vend={2}&{3}".format(
         job["channel_url"], job["start"].isoformat().replace("+00:00", "Z"), job["end"].isoformat().replace("+00:00", "Z"), meta_filter
     )
 
-    capture_path = tempfile.mkdtemp()
     file_name = "{0}--{1}.ismv".format(job["start"], job["end"])
 
     capture_file_path = os.path.join(capture_path, file_name)
@@ -68,64 +521,104 @@ def capture(job):
         capture_url,
     ]
     job["capture_command"] = capture_cmd
-    x = subprocess.run(
-        capture_cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        timeout=CAPTURE_TIMEOUT,
-    )
-    job["capture_returncode"] = x.returncode
-    job["capture_log"] = state.set_capture_log(x.stderr)
     job["capture_file_path"] = capture_file_path
 
+    archive = Archive(
+        job["channel_name"],
+        job["s3_endpoint"],
+        job["s3_access_key"],
+        job["s3_secret_key"],
+        job["s3_bucket"],
+        job["secure"],
+        part_size=job.get("s3_part_size", S3_PART_SIZE),
+        parallel_uploads=job.get("s3_parallel_uploads", S3_PARALLEL_UPLOADS),
+        part_retries=S3_RETRIES,
+    )
+
+    # stderr streams to redis as it comes, the full log optionally spills to
+    # disk to be stored beside the chunk
+    spill_path = None
+    if CAPTURE_LOG_SPILL:
+        spill_path = os.path.join(capture_path, "capture.log")
+    capture_log = CaptureLog(str(job["id"]), CAPTURE_LOG_MAX_BYTES, spill_path)
+
+    capture_start = time.monotonic()
+    try:
+        if CAPTURE_STREAMING_UPLOAD:
+            # upload parts while the capture is still writing
+            job["stages"]["s3_put"] = "starting"
+            state.set_job_stages(job)
+
+            def upload(data):
+                try:
+                    job["chunk_checksum"] = archive.put_chunk(
+                        job["chunk"], data, -1
+                    )
+                except CaptureFailed:
+                    pass
+
+            returncode = stream_capture(
+                str(job["id"]),
+                capture_cmd,
+                capture_log,
+                capture_file_path,
+                upload,
+            )
+        else:
+            returncode = run_capture_process(
+                str(job["id"]), capture_cmd, capture_log
+            )
+    finally:
+        capture_log.close()
+        CAPTURE_STAGE_SECONDS.labels("capture").observe(
+            time.monotonic() - capture_start
+        )
+
+    job["capture_returncode"] = returncode
+
+    # full log goes beside the chunk, redis only keeps a capped copy
+    log_location = None
+    if CAPTURE_LOG_SPILL and capture_log.size:
+        try:
+            log_location = archive.put_log(
+                job["chunk"], capture_log.spill_path
+            )
+        except Exception:
+            logger.exception(
+                "failed to store capture log for {0}".format(job["chunk"])
+            )
+    # already capped to CAPTURE_LOG_MAX_BYTES while it was written
+    job["capture_log"] = state.set_capture_log(
+        capture_log.getvalue(), location=log_location
+    )
+
     # if capture succeeded then do s3 upload
-    if x.returncode == 0:
+    if returncode == 0:
         job["stages"]["capture"] = "done"
-        job["stages"]["s3_put"] = "starting"
-        state.set_job_state(job)
 
-        archive = Archive(
-            job["channel_name"],
-            job["s3_endpoint"],
-            job["s3_access_key"],
-            job["s3_secret_key"],
-            job["s3_bucket"],
-            job["secure"],
-        )
+        if not CAPTURE_STREAMING_UPLOAD:
+            job["stages"]["s3_put"] = "starting"
+            state.set_job_stages(job)
 
-        file_stat = os.stat(capture_file_path)
+            file_stat = os.stat(capture_file_path)
 
-        with open(capture_file_path, "rb") as file_data:
-            archive.put_chunk(job["chunk"], file_data, file_stat.st_size)
+            with open(
+                capture_file_path, "rb"
+            ) as file_data, CAPTURE_STAGE_SECONDS.labels("s3_put").time():
+                job["chunk_checksum"] = archive.put_chunk(
+                    job["chunk"], file_data, file_stat.st_size
+                )
 
-        if os.path.exists(job["capture_file_path"]):
-            os.remove(job["capture_file_path"])
-        if os.path.exists(os.path.dirname(job["capture_file_path"])):
-            os.rmdir(os.path.dirname(job["capture_file_path"]))
         job["stages"]["s3_put"] = "done"
 
+        # size counted during upload and ETag, for verify_archive
         state.mark_chunk_complete(
             job["channel_name"],
             job["start"].timestamp(),
             job["chunk"],
+            job.get("chunk_checksum"),
         )
     else:
         job["stages"]["capture"] = "failed"
-        if os.path.exists(job["capture_file_path"]):
-            os.remove(job["capture_file_path"])
-        if os.path.exists(os.path.dirname(job["capture_file_path"])):
-            os.rmdir(os.path.dirname(job["capture_file_path"]))
-
-    # mark chunk as available
-    job["stages"]["mark_chunk_not_in_progress"] = "starting"
-    state.set_job_state(job)
-    state.mark_chunk_not_in_progress(job["chunk"])
-    job["stages"]["mark_chunk_not_in_progress"] = "done"
-
-    job_complete_time = datetime.utcnow()
-    job["complete_time"] = job_complete_time.isoformat()
-    job["complete_timestamp"] = job_complete_time.timestamp()
-
-    state.set_job_state(job)
-
-    return job
+        if CAPTURE_STREAMING_UPLOAD:
+            job["stages"]["s3_put"] = "aborted"
@@ -1,40 +1,117 @@
 """
 Master scheduler task
 """
-from archiver import celery, state
+from archiver import app, celery, state
 from archiver.utils.pub_point import PubPoint
 from archiver.utils.archive import Archive
+from archiver.utils.metrics import (
+    SCHEDULER_CHECK_SECONDS,
+    SCHEDULER_TICK_SECONDS,
+)
 from . import capture, archive
-from uuid import uuid4
+from celery import group
 from celery.utils.log import get_task_logger
+import time
+import zlib
 
 
 logger = get_task_logger(__name__)
 
+RECONCILE_INTERVAL = app.config["SCHEDULER_RECONCILE_INTERVAL"]
+SCHEDULER_INTERVAL = app.config["SCHEDULER_INTERVAL"]
+SCHEDULER_STAGGER = app.config["SCHEDULER_STAGGER"]
+CAPTURE_EXPIRING_WINDOW = app.config["CAPTURE_EXPIRING_WINDOW"]
+CAPTURE_LIVE_WINDOW = app.config["CAPTURE_LIVE_WINDOW"]
+CAPTURE_PREDICTIVE = app.config["CAPTURE_PREDICTIVE"]
+CHUNK_LEASE_TTL = app.config["CHUNK_LEASE_TTL"]
+
+# capture queues in order of urgency
+CAPTURE_QUEUES = ["capture_expiring", "capture_live", "capture_backfill"]
+
+
+def channel_hash(channel):
+    """
+    stable hash of channel name, the same in every process unlike hash()
+    """
+    return zlib.crc32(channel.encode("utf-8"))
+
+
+def capture_queue(chunk, window_start, live_edge):
+    """
+    pick capture queue for chunk based on how soon it will leave the
+    publishing point's /archive window and how close it is to the live edge
+    """
+    # a chunk can't be captured anymore once the window passed its start
+    expires_in = (chunk["start"] - window_start).total_seconds()
+    if expires_in <= CAPTURE_EXPIRING_WINDOW:
+        return "capture_expiring"
+    if (live_edge - chunk["end"]).total_seconds() <= CAPTURE_LIVE_WINDOW:
+        return "capture_live"
+    return "capture_backfill"
+
 
 @celery.task
-def master_scheduler():
+@SCHEDULER_TICK_SECONDS.time()
+def master_scheduler(shard=0, shards=1):
     """
     Fires off archive comparison tasks for each channel
+
+    With multiple shards only the channels hashing to this shard are checked,
+    and in staggered mode each channel is delayed by a fixed offset within the
+    scheduler interval so checks are spread out evenly
     """
-    channels = state.get_all_channels()
+    if not SCHEDULER_STAGGER and shards == 1:
+        channels = state.get_all_channels()
+
+        if not channels:
+            logger.info("No channels configured, nothing to do")
+            return
+
+        for channel, config in channels.items():
+            check_channel_archive.s(channel, config).apply_async()
+        return
+
+    channels = [
+        channel
+        for channel in state.get_all_channel_names()
+        if channel_hash(channel) % shards == shard
+    ]
 
     if not channels:
-        logger.info("No channels configured, nothing to do")
+        logger.info(f"No channels configured for shard {shard}, nothing to do")
         return
 
-    for channel, config in channels.items():
-        check_channel_archive.s(channel, config).apply_async()
+    checks = []
+    for channel in channels:
+        if SCHEDULER_STAGGER:
+            countdown = (channel_hash(channel) // shards) % SCHEDULER_INTERVAL
+        else:
+            countdown = 0
+        checks.append(
+            check_channel_archive.s(channel).set(
+                countdown=countdown, expires=countdown + SCHEDULER_INTERVAL
+            )
+        )
+
+    group(checks).apply_async()
 
 
 @celery.task
-def check_channel_archive(channel, config):
+@SCHEDULER_CHECK_SECONDS.time()
+def check_channel_archive(channel, config=None):
     """
     Checks channel by comparing the /archive to what is already archived
     If there are any new chunks available that aren't stored then trigger new
     capture task
     """
-    pp = PubPoint(config["channel_url"])
+    if config is None:
+        config = state.get_channel(channel)
+
+        if config is None:
+            logger.info(f"channel {channel} no longer configured")
+            return []
+
+    pp = PubPoint(config["channel_url"], state.get_pub_point_cache(channel))
     archive = Archive(
         channel,
         config["s3_endpoint"],
@@ -46,38 +123,101 @@ def check_channel_archive(channel, config):
 
     chunks = pp.get_video_chunks(config["chunk_duration"])
 
-    capture_tasks = []
-
-    for chunk in chunks:
-        if not archive.check_chunk_in_archive(chunk["start"], chunk["end"]):
-            chunk_name = "{0}/{1}/{2}--{3}.ismv".format(
-                channel,
-                chunk["start"].strftime("%Y-%m-%d"),
-                chunk["start"].isoformat().replace("+00:00", "Z"),
-                chunk["end"].isoformat().replace("+00:00", "Z"),
+    watermark = state.get_watermark(channel)
+    last_reconcile = state.get_last_reconcile(channel)
+
+    if (
+        watermark is None
+        or last_reconcile is None
+        or time.time() - last_reconcile >= RECONCILE_INTERVAL
+    ):
+        logger.info(f"full reconciliation of channel: {channel}")
+        candidates = chunks
+        state.set_last_reconcile(channel, time.time())
+    elif pp.not_modified:
+        logger.info(f"/archive unchanged for channel: {channel}")
+        # the next predicted capture may have been too far ahead before
+        if CAPTURE_PREDICTIVE and chunks:
+            capture.schedule_predicted_capture(
+                channel, config, max(chunk["end"] for chunk in chunks)
+            )
+        return []
+    else:
+        # only chunks completed since the last check and known gaps
+        known_missing = set(state.get_known_missing_chunks(channel).values())
+        candidates = [
+            chunk
+            for chunk in chunks
+            if chunk["start"].timestamp() >= watermark
+            or chunk["start"].timestamp() in known_missing
+        ]
+
+    # one listing per date prefix instead of a stat per chunk
+    archived_chunks = archive.check_chunks_in_archive(candidates)
+
+    video_ranges = pp.get_video_ranges()
+    if video_ranges:
+        window_start = min(r["start"] for r in video_ranges)
+        live_edge = max(r["end"] for r in video_ranges)
+
+    missing_chunks = {}
+    capture_jobs = []
+
+    for chunk in candidates:
+        chunk_name = archive.chunk_name(chunk["start"], chunk["end"])
+        if chunk_name not in archived_chunks:
+            missing_chunks[chunk_name] = chunk["start"].timestamp()
+            # the scheduled marker is taken atomically, so concurrent checks
+            # of the channel never queue the same chunk twice, it lasts until
+            # the capture had time to claim the chunk
+            chunk_in_progress = state.check_chunk_in_progress(
+                chunk_name
+            ) or not state.mark_chunk_scheduled(
+                chunk_name, SCHEDULER_INTERVAL + CHUNK_LEASE_TTL
             )
-            chunk_in_progress = state.check_chunk_in_progress(chunk_name)
             logger.info(
                 "{0} in_progress: {1}".format(chunk_name, chunk_in_progress)
             )
             if not chunk_in_progress:
-                job = {
-                    "id": uuid4(),
-                    "channel_name": channel,
-                    "channel_url": config["channel_url"],
-                    "start": chunk["start"],
-                    "end": chunk["end"],
-                    "s3_endpoint": config["s3_endpoint"],
-                    "s3_access_key": config["s3_access_key"],
-                    "s3_secret_key": config["s3_secret_key"],
-                    "s3_bucket": config["s3_bucket"],
-                    "secure": config["secure"],
-                    "stages": {},
-                }
-                logger.info(f"job before task create {job}")
-                capture_task = capture.capture.s(job).apply_async()
-
-                capture_tasks.append(repr(capture_task))
+                job = capture.new_job(
+                    channel,
+                    config,
+                    chunk["start"],
+                    chunk["end"],
+                    capture_queue(chunk, window_start, live_edge),
+                )
+                capture_jobs.append(job)
+
+    # most urgent first, oldest first for expiring chunks and newest first
+    # for the others
+    capture_jobs.sort(
+        key=lambda job: (
+            CAPTURE_QUEUES.index(job["queue"]),
+            job["start"].timestamp()
+            if job["queue"] == "capture_expiring"
+            else -job["start"].timestamp(),
+        )
+    )
+
+    capture_tasks = []
+
+    for job in capture_jobs:
+        logger.info(f"job before task create {job}")
+        capture_task = capture.capture.s(job).apply_async(queue=job["queue"])
+
+        capture_tasks.append(repr(capture_task))
+
+    # gaps outside the current /archive window are dropped here
+    state.set_known_missing_chunks(channel, missing_chunks)
+    if not pp.not_modified:
+        state.set_pub_point_cache(channel, pp.get_cache())
+    if chunks:
+        next_start = max(chunk["end"] for chunk in chunks)
+        state.set_watermark(channel, next_start.timestamp())
+
+        # (re)start the chain of predicted captures from the live edge
+        if CAPTURE_PREDICTIVE:
+            capture.schedule_predicted_capture(channel, config, next_start)
 
     if len(capture_tasks) == 0:
         logger.info("No gaps in archive which can be filled.")
@@ -86,16 +226,20 @@ def check_channel_archive(channel, config):
 
 
 @celery.task
-def archive_maintenance():
+def archive_maintenance(shard=0, shards=1):
     """
-    Triggers archive verification and cleanup for each channel
+    Triggers archive verification and cleanup for each channel of this shard
     """
-    channels = state.get_all_channels()
+    channels = [
+        channel
+        for channel in state.get_all_channel_names()
+        if channel_hash(channel) % shards == shard
+    ]
 
     if not channels:
-        logger.info("No channels configured, nothing to do")
+        logger.info(f"No channels configured for shard {shard}, nothing to do")
         return
 
-    for channel, config in channels.items():
+    for channel in channels:
         archive.verify_archive.s(channel).apply_async()
         archive.cleanup_archive.s(channel).apply_async()
@@ -1,7 +1,129 @@
 from minio import Minio
+from minio.deleteobjects import DeleteObject
 from minio.error import S3Error
+import certifi
+from concurrent.futures import ThreadPoolExecutor
 import isodate
 import datetime
+import gzip
+import os
+import shutil
+import threading
+import time
+import urllib3
+from archiver.utils.metrics import (
+    S3_REQUEST_SECONDS,
+    S3_UPLOAD_BYTES,
+    S3_UPLOAD_BYTES_PER_SECOND,
+)
+
+
+# same as the minio client defaults
+S3_TIMEOUT = 300
+S3_RETRY_BACKOFF = 0.2
+S3_RETRY_STATUSES = [500, 502, 503, 504]
+
+# date prefixes listed at once, within the client's connection pool size
+S3_LIST_CONCURRENCY = 8
+
+
+def chunk_name(channel_name, start, end):
+    """
+    object name of a channel's chunk between start and end
+    """
+    return "{0}/{1}/{2}--{3}.ismv".format(
+        channel_name,
+        start.strftime("%Y-%m-%d"),
+        start.isoformat().replace("+00:00", "Z"),
+        end.isoformat().replace("+00:00", "Z"),
+    )
+
+
+class ClientRegistry(object):
+    """
+    Minio clients shared by every Archive in a process, keyed by endpoint and
+    credentials so their HTTP connections are reused, and the buckets which
+    are known to exist for each
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.clients = {}
+        self.buckets = set()
+
+    def reset_after_fork(self):
+        # connections can't be shared with a parent process
+        if self.pid != os.getpid():
+            self.clients = {}
+            self.buckets = set()
+            self.pid = os.getpid()
+
+    def get(self, endpoint, access_key, secret_key, secure, maxsize, retries):
+        """
+        client for endpoint and credentials, with up to maxsize connections
+        per host and failed requests retried up to retries times
+        """
+        key = (endpoint, access_key, secret_key, secure, maxsize, retries)
+
+        with self.lock:
+            self.reset_after_fork()
+
+            client = self.clients.get(key)
+            if client is None:
+                http_client = urllib3.PoolManager(
+                    timeout=urllib3.Timeout(
+                        connect=S3_TIMEOUT, read=S3_TIMEOUT
+                    ),
+                    # enough connections for all parallel part uploads
+                    maxsize=maxsize,
+                    cert_reqs="CERT_REQUIRED",
+                    ca_certs=os.environ.get("SSL_CERT_FILE")
+                    or certifi.where(),
+                    retries=urllib3.Retry(
+                        total=retries,
+                        backoff_factor=S3_RETRY_BACKOFF,
+                        status_forcelist=S3_RETRY_STATUSES,
+                    ),
+                )
+                client = Minio(
+                    endpoint,
+                    access_key=access_key,
+                    secret_key=secret_key,
+                    secure=secure,
+                    http_client=http_client,
+                )
+                self.clients[key] = client
+
+            return client
+
+    def bucket_known(self, client, bucket):
+        with self.lock:
+            self.reset_after_fork()
+            return (id(client), bucket) in self.buckets
+
+    def add_bucket(self, client, bucket):
+        with self.lock:
+            self.reset_after_fork()
+            self.buckets.add((id(client), bucket))
+
+
+clients = ClientRegistry()
+
+
+class CountingReader(object):
+    """
+    Counts the bytes read from a file-like object
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.data.read(size)
+        self.size += len(data)
+        return data
 
 
 class Archive(object):
@@ -13,16 +135,32 @@ class Archive(object):
         s3_secret_key,
         s3_bucket,
         secure=True,
+        part_size=0,
+        parallel_uploads=3,
+        part_retries=5,
     ):
-        self.minio_client = Minio(
+        """
+        part_size and parallel_uploads control multipart uploads, part_size
+        0 lets minio pick one based on the object size, failed requests
+        including single parts are retried up to part_retries times
+        """
+        self.minio_client = clients.get(
             s3_endpoint,
-            access_key=s3_access_key,
-            secret_key=s3_secret_key,
-            secure=secure,
+            s3_access_key,
+            s3_secret_key,
+            secure,
+            max(10, parallel_uploads),
+            part_retries,
         )
+        self.part_size = part_size
+        self.parallel_uploads = parallel_uploads
         self.bucket = s3_bucket
-        if not self.minio_client.bucket_exists(self.bucket):
-            self.minio_client.make_bucket(self.bucket)
+        if not clients.bucket_known(self.minio_client, self.bucket):
+            with S3_REQUEST_SECONDS.labels("bucket_exists").time():
+                bucket_exists = self.minio_client.bucket_exists(self.bucket)
+            if not bucket_exists:
+                self.minio_client.make_bucket(self.bucket)
+            clients.add_bucket(self.minio_client, self.bucket)
         self.channel_name = channel_name
 
     def check_chunk_in_archive(self, start, end):
@@ -35,46 +173,154 @@ class Archive(object):
         if isinstance(end, str):
             end = datetime.fromisoformat(end)
 
-        date = start.strftime("%Y-%m-%d")
-        start_str = start.isoformat().replace("+00:00", "Z")
-        end_str = end.isoformat().replace("+00:00", "Z")
-
-        chunk = "{0}/{1}/{2}--{3}.ismv".format(
-            self.channel_name, date, start_str, end_str
-        )
+        chunk = self.chunk_name(start, end)
 
         # TODO: actual error handling
         try:
-            ob = self.minio_client.stat_object(self.bucket, chunk)
+            with S3_REQUEST_SECONDS.labels("stat_object").time():
+                ob = self.minio_client.stat_object(self.bucket, chunk)
             if ob.object_name == chunk:
                 return True
         except S3Error:
             return False
 
+    def check_chunks_in_archive(self, chunks):
+        """
+        check which of the given chunks are already in archive
+
+        lists each date prefix once and compares in memory, rather than a
+        stat_object round trip per chunk, returns set of archived chunk names
+        """
+        chunk_names = {
+            self.chunk_name(chunk["start"], chunk["end"]) for chunk in chunks
+        }
+        dates = {chunk["start"].date() for chunk in chunks}
+
+        archived = {name for name, _ in self.iter_chunk_objects(dates)}
+
+        return chunk_names & archived
+
+    def chunk_name(self, start, end):
+        """
+        object name of chunk between start and end
+        """
+        return chunk_name(self.channel_name, start, end)
+
     def put_chunk(self, chunk, data, length):
         """
-        Put chunk in archive
+        Put chunk in archive, length can be -1 to stream data of unknown size,
+        returns size and ETag of the uploaded object
         """
+        data = CountingReader(data)
+        start = time.monotonic()
+
         # TODO: actual error handling
-        put = self.minio_client.put_object(self.bucket, chunk, data, length)
+        with S3_REQUEST_SECONDS.labels("put_object").time():
+            put = self.minio_client.put_object(
+                self.bucket,
+                chunk,
+                data,
+                length,
+                part_size=self.part_size,
+                num_parallel_uploads=self.parallel_uploads,
+            )
+
+        S3_UPLOAD_BYTES.inc(data.size)
+        elapsed = time.monotonic() - start
+        if elapsed > 0:
+            S3_UPLOAD_BYTES_PER_SECOND.observe(data.size / elapsed)
+
         if put:
-            return put
+            return {
+                "size": data.size,
+                "etag": put.etag,
+            }
+
+    def put_log(self, chunk, log_path):
+        """
+        Put capture log file gzipped beside chunk in archive, returns its name
+        """
+        log_name = "{0}.log.gz".format(chunk)
+
+        with open(log_path, "rb") as log, gzip.open(
+            log_path + ".gz", "wb"
+        ) as gzipped_log:
+            shutil.copyfileobj(log, gzipped_log)
+
+        with S3_REQUEST_SECONDS.labels("put_log").time():
+            self.minio_client.fput_object(
+                self.bucket,
+                log_name,
+                log_path + ".gz",
+                content_type="application/gzip",
+            )
+
+        return log_name
+
+    def get_log(self, log_name):
+        """
+        Get capture log stored with put_log
+        """
+        with S3_REQUEST_SECONDS.labels("get_log").time():
+            response = self.minio_client.get_object(self.bucket, log_name)
+            try:
+                log = response.read()
+            finally:
+                response.close()
+                response.release_conn()
+
+        return gzip.decompress(log)
 
     def list_chunks(self, date=""):
         """
         list all chunks in archive, optionally restrict to single date
         """
+        return list(self.list_chunk_objects(date))
+
+    def list_chunk_objects(self, date=""):
+        """
+        list all chunks in archive with their size and ETag as listed by S3,
+        optionally restrict to single date
+        """
         if isinstance(date, datetime.date):
             date = date.strftime("%Y-%m-%d")
 
-        chunks = self.minio_client.list_objects(
-            self.bucket, prefix=f"{self.channel_name}/{date}", recursive=True
+        # listing is lazy, time it including all pages
+        with S3_REQUEST_SECONDS.labels("list_objects").time():
+            chunks = self.minio_client.list_objects(
+                self.bucket,
+                prefix=f"{self.channel_name}/{date}",
+                recursive=True,
+            )
+            return {
+                c.object_name: {"size": c.size, "etag": c.etag}
+                for c in chunks
+                if c.object_name.endswith(".ismv")
+            }
+
+    def iter_chunk_objects(self, dates):
+        """
+        lazily yield name and size and ETag of all chunks for the given
+        dates, in order of dates, listing up to S3_LIST_CONCURRENCY date
+        prefixes at once
+        """
+        dates = list(dates)
+        if not dates:
+            return
+
+        executor = ThreadPoolExecutor(
+            max_workers=min(S3_LIST_CONCURRENCY, len(dates))
         )
-        return [c.object_name for c in chunks]
+        try:
+            for date_chunks in executor.map(self.list_chunk_objects, dates):
+                yield from date_chunks.items()
+        finally:
+            executor.shutdown(cancel_futures=True)
 
-    def list_chunks_between(self, start, end):
+    @staticmethod
+    def dates_between(start, end):
         """
-        list all chunks between (inclusive) two dates
+        all dates between (inclusive) two dates
         """
         # type checking/forcing
         if isinstance(start, datetime.datetime):
@@ -86,18 +332,28 @@ class Archive(object):
         ):
             raise TypeError("start and end must be dates")
 
-        dates = [
+        return [
             start + datetime.timedelta(days=x)
             for x in range((end - start).days + 1)
         ]
 
-        chunks = [
-            chunk
-            for date_chunks in [self.list_chunks(date) for date in dates]
-            for chunk in date_chunks
-        ]
+    def list_chunks_between(self, start, end):
+        """
+        list all chunks between (inclusive) two dates, as a set
+        """
+        return {
+            name
+            for name, _ in self.iter_chunk_objects(
+                self.dates_between(start, end)
+            )
+        }
 
-        return chunks
+    def list_chunk_objects_between(self, start, end):
+        """
+        list all chunks between (inclusive) two dates with their size and
+        ETag as listed by S3
+        """
+        return dict(self.iter_chunk_objects(self.dates_between(start, end)))
 
     def delete_chunk(self, chunk):
         """
@@ -105,6 +361,28 @@ class Archive(object):
         """
         # TODO: error handling
         # TODO: verify object exists before delete and is gone after
-        self.minio_client.remove_object(self.bucket, chunk)
+        with S3_REQUEST_SECONDS.labels("remove_object").time():
+            self.minio_client.remove_object(self.bucket, chunk)
+            # capture log, if any was stored
+            self.minio_client.remove_object(self.bucket, f"{chunk}.log.gz")
 
         return True
+
+    def delete_chunks(self, chunks):
+        """
+        delete chunks and their capture logs from the archive, using multi
+        object deletes of up to 1000 objects per request, returns a dict of
+        object name to error for any which could not be deleted
+        """
+        objects = (
+            DeleteObject(name)
+            for chunk in chunks
+            for name in (chunk, f"{chunk}.log.gz")
+        )
+
+        with S3_REQUEST_SECONDS.labels("remove_objects").time():
+            errors = self.minio_client.remove_objects(self.bucket, objects)
+            return {
+                error.name: "{0}: {1}".format(error.code, error.message)
+                for error in errors
+            }
@@ -1,3 +1,6 @@
+import isodate
+
+
 def request_wants_json(request):
     """
     Helper function to check if request includes accept header application/json
@@ -10,3 +13,14 @@ def request_wants_json(request):
         and request.accept_mimetypes[best]
         > request.accept_mimetypes["text/html"]
     )
+
+
+def timestamp_arg(request, name):
+    """
+    Helper function to get an optional ISO 8601 datetime query argument as a
+    timestamp, raises ValueError if it can't be parsed
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return isodate.parse_datetime(value).timestamp()
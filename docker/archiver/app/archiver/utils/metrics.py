@@ -0,0 +1,117 @@
+"""
+Prometheus metrics
+
+Processes which fork, e.g. gunicorn workers or the Celery prefork pool, need
+PROMETHEUS_MULTIPROC_DIR set to a directory shared by all of them, so metrics
+are aggregated over all processes when collected
+"""
+import os
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+
+
+# chunks take from seconds to tens of minutes to capture and upload
+DURATION_BUCKETS = (
+    0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600,
+)
+REQUEST_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+THROUGHPUT_BUCKETS = tuple(2 ** x * 1024 * 1024 for x in range(-2, 11))
+
+CAPTURES = Counter(
+    "archiver_captures",
+    "Capture tasks by result",
+    ["result"],
+)
+CAPTURE_QUEUE_WAIT_SECONDS = Histogram(
+    "archiver_capture_queue_wait_seconds",
+    "Time capture tasks waited in their queue before starting",
+    ["queue"],
+    buckets=DURATION_BUCKETS,
+)
+CAPTURE_STAGE_SECONDS = Histogram(
+    "archiver_capture_stage_seconds",
+    "Time spent in each stage of a capture task",
+    ["stage"],
+    buckets=DURATION_BUCKETS,
+)
+S3_REQUEST_SECONDS = Histogram(
+    "archiver_s3_request_seconds",
+    "Time spent in S3 calls, including all requests of multipart uploads",
+    ["operation"],
+    buckets=REQUEST_BUCKETS + (600, 1200, 1800),
+)
+S3_UPLOAD_BYTES = Counter(
+    "archiver_s3_upload_bytes",
+    "Bytes of chunks uploaded to S3",
+)
+S3_UPLOAD_BYTES_PER_SECOND = Histogram(
+    "archiver_s3_upload_bytes_per_second",
+    "Throughput of chunk uploads to S3",
+    buckets=THROUGHPUT_BUCKETS,
+)
+PUB_POINT_SECONDS = Histogram(
+    "archiver_pub_point_seconds",
+    "Time spent fetching and parsing publishing point /archive",
+    ["phase"],
+    buckets=REQUEST_BUCKETS,
+)
+PUB_POINT_RESPONSES = Counter(
+    "archiver_pub_point_responses",
+    "Publishing point /archive responses by status code",
+    ["status"],
+)
+SCHEDULER_TICK_SECONDS = Histogram(
+    "archiver_scheduler_tick_seconds",
+    "Time taken by the master scheduler to dispatch channel checks",
+    buckets=REQUEST_BUCKETS,
+)
+SCHEDULER_CHECK_SECONDS = Histogram(
+    "archiver_scheduler_check_seconds",
+    "Time taken to check a channel's archive and queue its captures",
+    buckets=REQUEST_BUCKETS,
+)
+
+
+def multiprocess_mode():
+    return "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+
+def registry():
+    """
+    registry to collect from, aggregating all processes in multiprocess mode
+    """
+    if multiprocess_mode():
+        collector_registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collector_registry)
+        return collector_registry
+    return REGISTRY
+
+
+def latest():
+    """
+    current metrics in Prometheus text format, and their content type
+    """
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def start_exporter(port):
+    """
+    serve metrics over HTTP on port from a background thread
+    """
+    start_http_server(port, registry=registry())
+
+
+def process_dead(pid):
+    """
+    clean up live gauges of a process which exited, in multiprocess mode
+    """
+    if multiprocess_mode():
+        multiprocess.mark_process_dead(pid)
@@ -4,36 +4,97 @@ Functionality to parse publishing point archive
 import requests
 from lxml import etree
 import isodate
+from archiver.utils.metrics import PUB_POINT_RESPONSES, PUB_POINT_SECONDS
 from datetime import datetime
 
 
 EPOCH = datetime(1970, 1, 1, tzinfo=isodate.tzinfo.UTC)
 
+# re-use connections to origins between checks
+session = requests.Session()
+
 
 class PubPoint(object):
-    def __init__(self, url):
+    def __init__(self, url, cache=None):
+        """
+        fetch and parse the publishing point /archive
+
+        cache is the result of a previous get_cache() for the same channel,
+        if given the request is made conditional and an unchanged archive is
+        not downloaded or parsed again, check not_modified afterwards
+        """
         self.url = url
+        self.etag = None
+        self.last_modified = None
+        self.not_modified = False
+
+        headers = {}
+        if cache:
+            if cache.get("etag"):
+                headers["If-None-Match"] = cache["etag"]
+            if cache.get("last_modified"):
+                headers["If-Modified-Since"] = cache["last_modified"]
+
         # TODO: proper error handling on get + parse
-        response = requests.get("{url}/archive".format(url=url))
-        if response.status_code == 200:
-            self.archive = etree.fromstring(response.content)
-        else:
-            raise Exception("failed to get or parse pub point archive")
+        with PUB_POINT_SECONDS.labels("fetch").time():
+            response = session.get(
+                "{url}/archive".format(url=url), headers=headers, stream=True
+            )
+        PUB_POINT_RESPONSES.labels(response.status_code).inc()
 
-    def get_video_ranges(self):
+        with response:
+            if response.status_code == 304 and cache:
+                self.not_modified = True
+                self.etag = cache.get("etag")
+                self.last_modified = cache.get("last_modified")
+                self.video_ranges = cache["ranges"]
+            elif response.status_code == 200:
+                self.etag = response.headers.get("ETag")
+                self.last_modified = response.headers.get("Last-Modified")
+                # parse straight from the socket rather than buffering
+                response.raw.decode_content = True
+                with PUB_POINT_SECONDS.labels("parse").time():
+                    self.video_ranges = self.parse_video_ranges(response.raw)
+            else:
+                raise Exception("failed to get or parse pub point archive")
+
+    @staticmethod
+    def parse_video_ranges(source):
         """
-        return a list of all video ranges in archive
+        incrementally parse video ranges from an /archive document, freeing
+        elements as they are consumed to keep memory flat for long archives
         """
         video_ranges = []
-        for c in self.archive.findall(".//{*}video/{*}c"):
-            video_ranges.append(
-                {
-                    "start": datetime.fromisoformat(c.attrib["start"]),
-                    "end": datetime.fromisoformat(c.attrib["end"]),
-                }
-            )
+        for _, c in etree.iterparse(source, events=("end",), tag="{*}c"):
+            parent = c.getparent()
+            if etree.QName(parent).localname == "video":
+                video_ranges.append(
+                    {
+                        "start": datetime.fromisoformat(c.attrib["start"]),
+                        "end": datetime.fromisoformat(c.attrib["end"]),
+                    }
+                )
+            c.clear()
+            while c.getprevious() is not None:
+                del parent[0]
         return video_ranges
 
+    def get_cache(self):
+        """
+        return validators and parsed ranges to pass to the next PubPoint
+        """
+        return {
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "ranges": self.video_ranges,
+        }
+
+    def get_video_ranges(self):
+        """
+        return a list of all video ranges in archive
+        """
+        return list(self.video_ranges)
+
     def get_video_chunks(self, chunk_duration):
         """
         return a list of complete chunks
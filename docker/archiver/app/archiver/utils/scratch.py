@@ -0,0 +1,161 @@
+"""
+Scratch space for captures in progress
+"""
+import fcntl
+import os
+import shutil
+from uuid import uuid4
+
+
+SCRATCH_DIR_PREFIX = "capture-"
+RESERVATION_FILE = ".reservation"
+LOCK_FILE = ".scratch.lock"
+
+
+def dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class Reservation(object):
+    """
+    A capture directory with space reserved for it, locked for as long as it
+    is in use so it is never swept as an orphan
+    """
+
+    def __init__(self, path, size, lock_fd):
+        self.path = path
+        self.size = size
+        self.lock_fd = lock_fd
+
+    def release(self):
+        """
+        remove the directory and give its space back
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.close(self.lock_fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class ScratchSpace(object):
+    """
+    Hands out capture directories under root, only when the filesystem has
+    room for the expected size on top of what running captures, possibly in
+    other worker processes on the same node, have reserved but not yet
+    written
+    """
+
+    def __init__(self, root, min_free=0):
+        self.root = root
+        self.min_free = min_free
+
+    def capture_dirs(self):
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return [
+            os.path.join(self.root, name)
+            for name in names
+            if name.startswith(SCRATCH_DIR_PREFIX)
+        ]
+
+    def lock(self):
+        os.makedirs(self.root, exist_ok=True)
+        fd = os.open(
+            os.path.join(self.root, LOCK_FILE), os.O_RDWR | os.O_CREAT
+        )
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    @staticmethod
+    def try_lock_dir(path):
+        """
+        lock a capture directory, returns the lock fd or None if it is in use
+        """
+        try:
+            fd = os.open(os.path.join(path, RESERVATION_FILE), os.O_RDWR)
+        except OSError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def outstanding(self):
+        """
+        bytes reserved by captures in progress which they haven't written yet
+        """
+        outstanding = 0
+        for path in self.capture_dirs():
+            try:
+                with open(os.path.join(path, RESERVATION_FILE)) as f:
+                    reserved = int(f.read() or 0)
+            except (OSError, ValueError):
+                continue
+            outstanding += max(reserved - dir_size(path), 0)
+        return outstanding
+
+    def available(self):
+        stat = os.statvfs(self.root)
+        return stat.f_bavail * stat.f_frsize - self.outstanding()
+
+    def reserve(self, size):
+        """
+        create a capture directory with size bytes reserved, returns a
+        Reservation or None if there isn't enough space
+        """
+        lock_fd = self.lock()
+        try:
+            if self.available() - size < self.min_free:
+                return None
+
+            path = os.path.join(
+                self.root, "{0}{1}".format(SCRATCH_DIR_PREFIX, uuid4())
+            )
+            os.mkdir(path)
+            fd = os.open(
+                os.path.join(path, RESERVATION_FILE),
+                os.O_RDWR | os.O_CREAT,
+            )
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, str(size).encode("ascii"))
+
+            return Reservation(path, size, fd)
+        finally:
+            os.close(lock_fd)
+
+    def sweep(self):
+        """
+        remove capture directories left behind by captures which are no
+        longer running, e.g. after a worker was killed, returns their paths
+        """
+        lock_fd = self.lock()
+        try:
+            swept = []
+            for path in self.capture_dirs():
+                fd = self.try_lock_dir(path)
+                if fd is None and os.path.exists(
+                    os.path.join(path, RESERVATION_FILE)
+                ):
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                if fd is not None:
+                    os.close(fd)
+                swept.append(path)
+            return swept
+        finally:
+            os.close(lock_fd)
@@ -1,47 +1,270 @@
 from kombu.serialization import dumps, loads
+from archiver.utils.state_codec import pack_job, pack_state, unpack
+from itertools import islice
+import copy
+import os
+import threading
 from uuid import uuid4
+import time
+import zlib
 
 
 CHANNEL_CONFIG_HASH = "channels"
-IN_PROGRESS_SET = "archiver_in_progress"
+CHANNEL_INVALIDATE_CHANNEL = "archiver_channel_changed"
+CHANNEL_CACHE_TTL = 60
+CHUNK_LEASE_PREFIX = "archiver_lease"
+CHUNK_SCHEDULED_PREFIX = "archiver_scheduled"
+CAPTURE_SLOTS_PREFIX = "archiver_slots"
 CAPTURE_LOG_PREFIX = "capture_log"
+CAPTURE_LOG_STREAM_PREFIX = "capture_log_stream"
+# live logs are only followed while their capture runs
+CAPTURE_LOG_STREAM_EOF_TTL = 600
 JOB_STATE_PREFIX = "archiver_job"
+JOB_STAGES_PREFIX = "archiver_stages"
 JOB_STATE_TTL = 86400
+JOB_READ_BATCH = 500
+JOB_INDEX = "archiver_jobs"
+JOB_CHANNEL_INDEX_PREFIX = "archiver_jobs_channel"
+JOB_STATUS_INDEX_PREFIX = "archiver_jobs_status"
+JOB_STATUSES = ["running", "deferred", "rejected", "failed", "done"]
 ARCHIVE_STATE_PREFIX = "archive"
+ARCHIVE_CHECKSUM_PREFIX = "archive_checksums"
+WATERMARK_HASH = "archiver_watermark"
+RECONCILE_HASH = "archiver_reconcile"
+KNOWN_MISSING_PREFIX = "archiver_missing"
+PUB_POINT_CACHE_HASH = "archiver_pub_point"
+
+# only touch a lease if it is still held by the caller
+RENEW_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# take a slot in every semaphore or none, holders are scored by expiry time so
+# slots of dead workers free up by themselves
+ACQUIRE_SLOTS_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    redis.call("zremrangebyscore", key, "-inf", ARGV[2])
+    if redis.call("zcard", key) >= tonumber(ARGV[i + 3]) then
+        return 0
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call("zadd", key, ARGV[3], ARGV[1])
+    redis.call("expireat", key, math.ceil(tonumber(ARGV[3])))
+end
+return 1
+"""
+
+
+def batched(iterable, size):
+    """
+    split iterable into lists of up to size items
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def job_status(job):
+    """
+    overall status of a job from its stages
+    """
+    stages = job.get("stages", {})
+    if stages.get("claim_chunk") == "rejected":
+        return "rejected"
+    if "deferred" in stages.values():
+        return "deferred"
+    if "complete_timestamp" in job:
+        return "done" if stages.get("s3_put") == "done" else "failed"
+    if stages.get("capture") == "failed":
+        return "failed"
+    return "running"
+
+
+def truncate_log(log, max_bytes):
+    """
+    cap log to about max_bytes, keeping its head and tail
+    """
+    if len(log) <= max_bytes:
+        return log
+
+    head = log[: max_bytes // 2]
+    tail = log[len(log) - max_bytes // 2 :]
+
+    return head + truncation_marker(len(log) - len(head) - len(tail)) + tail
+
+
+def truncation_marker(truncated):
+    return "\n[... {0} bytes truncated ...]\n".format(truncated).encode(
+        "utf-8"
+    )
+
 
 # re-use the existing Celery backend
 
 
+class ChannelCache(object):
+    """
+    In-process copy of channel configs, entries are dropped when a channel
+    changed message is published by any process and expire after
+    CHANNEL_CACHE_TTL seconds in case a message was missed. Nothing is cached
+    while not subscribed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.pid = None
+        self.entries = {}
+        self.generation = 0
+        self.subscribed = False
+
+    def start(self):
+        # the listener thread doesn't survive a fork, so start one per process
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.entries = {}
+                self.subscribed = False
+                threading.Thread(target=self.listen, daemon=True).start()
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = self.app.backend.client.pubsub(
+                    ignore_subscribe_messages=True
+                )
+                pubsub.subscribe(CHANNEL_INVALIDATE_CHANNEL)
+                self.subscribed = True
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self.invalidate(
+                            str(
+                                message["data"],
+                                self.app.backend.content_encoding,
+                            )
+                        )
+            except Exception:
+                # changes may be missed while not subscribed
+                self.subscribed = False
+                self.invalidate()
+                time.sleep(1)
+
+    def invalidate(self, channel_name=None):
+        with self.lock:
+            self.generation += 1
+            if channel_name is None:
+                self.entries = {}
+            else:
+                self.entries.pop(channel_name, None)
+
+    def get(self, channel_name, fetch):
+        """
+        get channel config from cache, or with fetch if not cached
+        """
+        self.start()
+
+        with self.lock:
+            entry = self.entries.get(channel_name)
+            generation = self.generation
+        if entry is not None and time.monotonic() < entry[1]:
+            return copy.deepcopy(entry[0])
+
+        channel_config = fetch(channel_name)
+
+        with self.lock:
+            # don't store configs which changed while being fetched
+            if (
+                channel_config is not None
+                and self.subscribed
+                and generation == self.generation
+            ):
+                self.entries[channel_name] = (
+                    copy.deepcopy(channel_config),
+                    time.monotonic() + CHANNEL_CACHE_TTL,
+                )
+
+        return channel_config
+
+
 class StateBackend(object):
     def __init__(self, app):
         self.app = app
+        self.channel_cache = ChannelCache(app)
+        self.scripts = {}
+
+    def legacy_loads(self, data):
+        """
+        decode state stored as kombu JSON before the compact encoding
+        """
+        return loads(
+            data,
+            content_type=self.app.backend.content_type,
+            content_encoding=self.app.backend.content_encoding,
+            accept=self.app.backend.accept,
+        )
+
+    def run_script(self, source, keys, args):
+        """
+        run a Lua script, registered once and run with the current client,
+        which is per thread
+        """
+        script = self.scripts.get(source)
+        if script is None:
+            script = self.app.backend.client.register_script(source)
+            self.scripts[source] = script
+        return script(keys=keys, args=args, client=self.app.backend.client)
 
     # channel config
     def set_channel(self, channel_name, channel_config):
-        _, _, encoded_channel_config = dumps(
-            channel_config, serializer=self.app.backend.serializer
-        )
+        encoded_channel_config = pack_state(channel_config)
 
-        return self.app.backend.client.hset(
-            CHANNEL_CONFIG_HASH, channel_name, encoded_channel_config
-        )
+        # config may have changed, force a full reconciliation on next check
+        self.reset_watermark(channel_name)
+
+        pipe = self.app.backend.client.pipeline()
+        pipe.hset(CHANNEL_CONFIG_HASH, channel_name, encoded_channel_config)
+        pipe.publish(CHANNEL_INVALIDATE_CHANNEL, channel_name)
+        result = pipe.execute()[0]
+        self.channel_cache.invalidate(channel_name)
+        return result
 
     def get_channel(self, channel_name):
+        """
+        get channel config, cached in process until it is changed
+        """
+        return self.channel_cache.get(channel_name, self.fetch_channel)
+
+    def fetch_channel(self, channel_name):
         channel_config = self.app.backend.client.hget(
             CHANNEL_CONFIG_HASH, channel_name
         )
 
-        decoded_channel_config = loads(
-            channel_config,
-            content_type=self.app.backend.content_type,
-            content_encoding=self.app.backend.content_encoding,
-            accept=self.app.backend.accept,
-        )
-
-        return decoded_channel_config
+        return unpack(channel_config, self.legacy_loads)
 
     def delete_channel(self, channel_name):
-        return self.app.backend.client.hdel(CHANNEL_CONFIG_HASH, channel_name)
+        self.reset_watermark(channel_name)
+
+        pipe = self.app.backend.client.pipeline()
+        pipe.hdel(CHANNEL_CONFIG_HASH, channel_name)
+        pipe.publish(CHANNEL_INVALIDATE_CHANNEL, channel_name)
+        result = pipe.execute()[0]
+        self.channel_cache.invalidate(channel_name)
+        return result
 
     def get_all_channels(self):
         all_channels = self.app.backend.client.hgetall(CHANNEL_CONFIG_HASH)
@@ -49,12 +272,7 @@ class StateBackend(object):
         decoded_channels = {}
 
         for channel_name, channel_config in all_channels.items():
-            decoded_channel_config = loads(
-                channel_config,
-                content_type=self.app.backend.content_type,
-                content_encoding=self.app.backend.content_encoding,
-                accept=self.app.backend.accept,
-            )
+            decoded_channel_config = unpack(channel_config, self.legacy_loads)
             decoded_channel_name = str(
                 channel_name, self.app.backend.content_encoding
             )
@@ -62,15 +280,200 @@ class StateBackend(object):
 
         return decoded_channels
 
+    def get_all_channel_names(self):
+        """
+        list channel names without fetching and decoding their configs
+        """
+        return [
+            str(channel_name, self.app.backend.content_encoding)
+            for channel_name in self.app.backend.client.hkeys(
+                CHANNEL_CONFIG_HASH
+            )
+        ]
+
+    # scheduler watermark
+    def get_watermark(self, channel):
+        """
+        end timestamp of the newest chunk already evaluated by the scheduler
+        """
+        watermark = self.app.backend.client.hget(WATERMARK_HASH, channel)
+
+        if watermark is not None:
+            return float(watermark)
+
+    def set_watermark(self, channel, timestamp):
+        return self.app.backend.client.hset(WATERMARK_HASH, channel, timestamp)
+
+    def get_last_reconcile(self, channel):
+        """
+        timestamp of last full reconciliation of the channel archive
+        """
+        last_reconcile = self.app.backend.client.hget(RECONCILE_HASH, channel)
+
+        if last_reconcile is not None:
+            return float(last_reconcile)
+
+    def set_last_reconcile(self, channel, timestamp):
+        return self.app.backend.client.hset(RECONCILE_HASH, channel, timestamp)
+
+    def reset_watermark(self, channel):
+        """
+        forget watermark and known missing chunks so the next check does a
+        full reconciliation
+        """
+        pipe = self.app.backend.client.pipeline()
+        pipe.hdel(WATERMARK_HASH, channel)
+        pipe.hdel(RECONCILE_HASH, channel)
+        pipe.delete("{0}-{1}".format(KNOWN_MISSING_PREFIX, channel))
+        pipe.hdel(PUB_POINT_CACHE_HASH, channel)
+        return pipe.execute()
+
+    def get_known_missing_chunks(self, channel):
+        """
+        get chunks known to be missing from the archive, as a dict of chunk
+        name to start timestamp
+        """
+        chunks = self.app.backend.client.zrange(
+            "{0}-{1}".format(KNOWN_MISSING_PREFIX, channel),
+            0,
+            -1,
+            withscores=True,
+        )
+
+        return {
+            str(chunk, self.app.backend.content_encoding): timestamp
+            for chunk, timestamp in chunks
+        }
+
+    def set_known_missing_chunks(self, channel, chunks):
+        """
+        replace the set of chunks known to be missing from the archive, takes
+        a dict of chunk name to start timestamp
+        """
+        missing_key = "{0}-{1}".format(KNOWN_MISSING_PREFIX, channel)
+
+        pipe = self.app.backend.client.pipeline()
+        pipe.delete(missing_key)
+        if chunks:
+            pipe.zadd(missing_key, chunks)
+        return pipe.execute()
+
+    # publishing point /archive cache
+    def get_pub_point_cache(self, channel):
+        """
+        get validators and parsed ranges of the last /archive fetched
+        """
+        cache = self.app.backend.client.hget(PUB_POINT_CACHE_HASH, channel)
+
+        if cache is not None:
+            return loads(
+                cache,
+                content_type=self.app.backend.content_type,
+                content_encoding=self.app.backend.content_encoding,
+                accept=self.app.backend.accept,
+            )
+
+    def set_pub_point_cache(self, channel, cache):
+        _, _, encoded_cache = dumps(
+            cache, serializer=self.app.backend.serializer
+        )
+
+        return self.app.backend.client.hset(
+            PUB_POINT_CACHE_HASH, channel, encoded_cache
+        )
+
     # in progress archive task management
-    def mark_chunk_in_progress(self, chunk):
-        return self.app.backend.client.sadd(IN_PROGRESS_SET, chunk)
+    def claim_chunk(self, chunk, owner, ttl):
+        """
+        atomically claim a chunk for capture, returns True if this owner won
+        the claim, which expires after ttl seconds unless renewed
+        """
+        lease_key = "{0}_{1}".format(CHUNK_LEASE_PREFIX, chunk)
 
-    def check_chunk_in_progress(self, chunk):
-        return self.app.backend.client.sismember(IN_PROGRESS_SET, chunk)
+        return bool(
+            self.app.backend.client.set(lease_key, owner, nx=True, ex=ttl)
+        )
+
+    def renew_chunk_claim(self, chunk, owner, ttl):
+        """
+        extend claim on chunk, returns False if no longer held by owner
+        """
+        lease_key = "{0}_{1}".format(CHUNK_LEASE_PREFIX, chunk)
+
+        return bool(
+            self.run_script(RENEW_LEASE_SCRIPT, [lease_key], [owner, ttl])
+        )
 
-    def mark_chunk_not_in_progress(self, chunk):
-        return self.app.backend.client.srem(IN_PROGRESS_SET, chunk)
+    def release_chunk_claim(self, chunk, owner):
+        """
+        release claim on chunk, if still held by owner
+        """
+        lease_key = "{0}_{1}".format(CHUNK_LEASE_PREFIX, chunk)
+
+        return bool(
+            self.run_script(RELEASE_LEASE_SCRIPT, [lease_key], [owner])
+        )
+
+    def mark_chunk_scheduled(self, chunk, ttl):
+        """
+        mark chunk as having a capture scheduled for later, returns False if
+        one was already scheduled
+        """
+        return bool(
+            self.app.backend.client.set(
+                "{0}_{1}".format(CHUNK_SCHEDULED_PREFIX, chunk),
+                1,
+                nx=True,
+                ex=ttl,
+            )
+        )
+
+    # capture admission control
+    def capture_slot_key(self, kind, name):
+        return "{0}_{1}_{2}".format(CAPTURE_SLOTS_PREFIX, kind, name)
+
+    def acquire_capture_slots(self, holder, limits, ttl):
+        """
+        take a slot in each of the given semaphores for holder, takes a dict
+        of slot key to limit, returns False and takes nothing if any is full
+        """
+        if not limits:
+            return True
+
+        now = time.time()
+        keys = list(limits)
+
+        return bool(
+            self.run_script(
+                ACQUIRE_SLOTS_SCRIPT,
+                keys,
+                [holder, now, now + ttl] + [limits[k] for k in keys],
+            )
+        )
+
+    def renew_capture_slots(self, holder, keys, ttl):
+        expiry = time.time() + ttl
+
+        pipe = self.app.backend.client.pipeline()
+        for key in keys:
+            pipe.zadd(key, {holder: expiry}, xx=True)
+            pipe.expireat(key, int(expiry) + 1)
+        return pipe.execute()
+
+    def release_capture_slots(self, holder, keys):
+        pipe = self.app.backend.client.pipeline()
+        for key in keys:
+            pipe.zrem(key, holder)
+        return pipe.execute()
+
+    def check_chunk_in_progress(self, chunk):
+        """
+        check if chunk is claimed by a capture or has one scheduled
+        """
+        return self.app.backend.client.exists(
+            "{0}_{1}".format(CHUNK_LEASE_PREFIX, chunk),
+            "{0}_{1}".format(CHUNK_SCHEDULED_PREFIX, chunk),
+        )
 
     # job state
     def set_job_state(self, job):
@@ -78,29 +481,181 @@ class StateBackend(object):
         set job status, if job_id not specified will create one
         """
         job_key = "{0}_{1}".format(JOB_STATE_PREFIX, job["id"])
+        stages_key = "{0}_{1}".format(JOB_STAGES_PREFIX, job["id"])
 
-        _, _, encoded_job = dumps(job, serializer=self.app.backend.serializer)
+        encoded_job = pack_job(job)
 
-        return self.app.backend.client.setex(
-            job_key, JOB_STATE_TTL, encoded_job
-        )
+        # full state includes all stages, so drop any separately set ones
+        pipe = self.app.backend.client.pipeline()
+        pipe.setex(job_key, JOB_STATE_TTL, encoded_job)
+        pipe.delete(stages_key)
+        self.index_job(pipe, job)
+        return pipe.execute()[0]
+
+    def index_job(self, pipe, job):
+        """
+        add job to the time ordered indexes of all jobs, its channel's jobs
+        and jobs with its current status, dropping entries of expired jobs
+        """
+        score = job.get("start_timestamp", time.time())
+        status = job_status(job)
+        expired = time.time() - JOB_STATE_TTL
+
+        for status_index in JOB_STATUSES:
+            if status_index != status:
+                pipe.zrem(
+                    "{0}_{1}".format(JOB_STATUS_INDEX_PREFIX, status_index),
+                    str(job["id"]),
+                )
+
+        for index in (
+            JOB_INDEX,
+            "{0}_{1}".format(JOB_CHANNEL_INDEX_PREFIX, job["channel_name"]),
+            "{0}_{1}".format(JOB_STATUS_INDEX_PREFIX, status),
+        ):
+            pipe.zadd(index, {str(job["id"]): score})
+            pipe.zremrangebyscore(index, "-inf", expired)
+            pipe.expire(index, JOB_STATE_TTL)
+
+    def find_jobs(
+        self,
+        channel=None,
+        status=None,
+        since=None,
+        until=None,
+        cursor=None,
+        limit=100,
+    ):
+        """
+        find jobs newest first, optionally of a channel and with a status,
+        started between since and until. returns up to limit job ids and
+        states, and a cursor to pass for the next page or None at the end,
+        cursors are (score, job id) tuples
+        """
+        # a job's status changes less often than there are jobs per channel
+        if status is not None:
+            index = "{0}_{1}".format(JOB_STATUS_INDEX_PREFIX, status)
+        elif channel is not None:
+            index = "{0}_{1}".format(JOB_CHANNEL_INDEX_PREFIX, channel)
+        else:
+            index = JOB_INDEX
+
+        max_score = "+inf" if until is None else until
+        if cursor is not None:
+            max_score = cursor[0]
+        min_score = "-inf" if since is None else since
+
+        # jobs with the same score are ordered by id, newest first, so the
+        # cursor is the score and id of the last job returned, the offset
+        # skips entries with the score of the last one already read
+        offset = 0
+        jobs = []
+        while len(jobs) < limit:
+            entries = self.app.backend.client.zrevrangebyscore(
+                index,
+                max_score,
+                min_score,
+                start=offset,
+                num=JOB_READ_BATCH,
+                withscores=True,
+            )
+            if not entries:
+                return jobs, None
+
+            positions = [
+                (score, str(id, self.app.backend.content_encoding))
+                for id, score in entries
+            ]
+            scores = {id: score for score, id in positions}
+            ids = [
+                id
+                for score, id in positions
+                if cursor is None or (score, id) < cursor
+            ]
+
+            for id, job in self.get_job_states(ids):
+                if channel is not None and job.get("channel_name") != channel:
+                    continue
+                if status is not None and job_status(job) != status:
+                    continue
+                jobs.append((id, job))
+                if len(jobs) == limit:
+                    return jobs, (scores[id], id)
+
+            last_score = positions[-1][0]
+            tied = sum(1 for score, _ in positions if score == last_score)
+            if last_score == max_score:
+                offset += tied
+            else:
+                max_score = last_score
+                offset = tied
+
+        return jobs, None
+
+    def set_job_stages(self, job):
+        """
+        update only the stages of a job already stored with set_job_state,
+        all stage transitions since the last write go out in one pipeline as
+        hash fields rather than re-serialising the whole job
+        """
+        stages_key = "{0}_{1}".format(JOB_STAGES_PREFIX, job["id"])
+
+        pipe = self.app.backend.client.pipeline(transaction=False)
+        pipe.hset(stages_key, mapping=job["stages"])
+        pipe.expire(stages_key, JOB_STATE_TTL)
+        return pipe.execute()
+
+    def decode_job_state(self, job_state, stages):
+        """
+        decode job state and overlay any stages set separately
+        """
+        decoded_job_state = unpack(job_state, self.legacy_loads)
+
+        if decoded_job_state is not None and stages:
+            decoded_job_state["stages"].update(
+                {
+                    str(stage, self.app.backend.content_encoding): str(
+                        status, self.app.backend.content_encoding
+                    )
+                    for stage, status in stages.items()
+                }
+            )
+
+        return decoded_job_state
 
     def get_job_state(self, id):
         """
         get job state
         """
         job_key = "{0}_{1}".format(JOB_STATE_PREFIX, id)
+        stages_key = "{0}_{1}".format(JOB_STAGES_PREFIX, id)
 
-        job_state = self.app.backend.client.get(job_key)
+        pipe = self.app.backend.client.pipeline(transaction=False)
+        pipe.get(job_key)
+        pipe.hgetall(stages_key)
+        job_state, stages = pipe.execute()
 
-        decoded_job_state = loads(
-            job_state,
-            content_type=self.app.backend.content_type,
-            content_encoding=self.app.backend.content_encoding,
-            accept=self.app.backend.accept,
-        )
+        return self.decode_job_state(job_state, stages)
 
-        return decoded_job_state
+    def get_job_states(self, ids):
+        """
+        get states of many jobs, one pipeline per JOB_READ_BATCH jobs, yields
+        job id and state of each job which still exists
+        """
+        for batch in batched(ids, JOB_READ_BATCH):
+            pipe = self.app.backend.client.pipeline(transaction=False)
+            for id in batch:
+                pipe.get("{0}_{1}".format(JOB_STATE_PREFIX, id))
+                pipe.hgetall("{0}_{1}".format(JOB_STAGES_PREFIX, id))
+            results = pipe.execute()
+
+            for id, job_state, stages in zip(
+                batch, results[0::2], results[1::2]
+            ):
+                decoded_job_state = self.decode_job_state(job_state, stages)
+                # may have expired since it was found
+                if decoded_job_state is not None:
+                    yield id, decoded_job_state
 
     def get_all_jobs(self):
         """
@@ -110,57 +665,159 @@ class StateBackend(object):
             match="{0}_*".format(JOB_STATE_PREFIX)
         )
 
-    def get_all_job_states(self):
-        job_states = {}
-
-        job_state_keys = self.app.backend.client.scan_iter(
-            match="{0}_*".format(JOB_STATE_PREFIX)
-        )
-
-        for key in job_state_keys:
-            key = str(key, self.app.backend.content_encoding).replace(
-                "{0}_".format(JOB_STATE_PREFIX), "", 1
-            )
-            job_states[key] = self.get_job_state(key)
-
-        return job_states
-
     # job logs
-    def set_capture_log(self, stderr):
+    def set_capture_log(self, stderr, max_bytes=None, location=None):
         """
-        store stderr for capture command
+        store stderr for capture command, compressed and optionally capped to
+        max_bytes keeping the head and tail, optionally with the location of
+        the full log if it was stored elsewhere
         """
         log_key = "{0}_{1}".format(CAPTURE_LOG_PREFIX, uuid4())
 
-        self.app.backend.client.hset(log_key, "stderr", stderr)
+        if max_bytes is not None:
+            stderr = truncate_log(stderr, max_bytes)
+
+        capture_log = {"stderr_z": zlib.compress(stderr)}
+        if location is not None:
+            capture_log["location"] = location
 
+        pipe = self.app.backend.client.pipeline()
+        pipe.hset(log_key, mapping=capture_log)
         # set expiry same as job state
-        self.app.backend.client.expire(log_key, JOB_STATE_TTL)
+        pipe.expire(log_key, JOB_STATE_TTL)
+        pipe.execute()
 
         return log_key
 
     def get_capture_log(self, log_key):
+        capture_log = self.app.backend.client.hgetall(log_key)
 
-        return {
-            "stderr": str(
-                self.app.backend.client.hget(log_key, "stderr"),
-                self.app.backend.content_encoding,
-            )
+        if b"stderr_z" in capture_log:
+            stderr = zlib.decompress(capture_log[b"stderr_z"])
+        else:
+            # stored uncompressed by older versions
+            stderr = capture_log.get(b"stderr", b"")
+
+        decoded_capture_log = {
+            "stderr": str(stderr, self.app.backend.content_encoding, "replace")
         }
+        if b"location" in capture_log:
+            decoded_capture_log["location"] = str(
+                capture_log[b"location"], self.app.backend.content_encoding
+            )
+
+        return decoded_capture_log
+
+    def append_capture_log_stream(self, job_id, data, eof=False, min_id=None):
+        """
+        append a piece of a running capture's log to its live stream, after
+        dropping entries older than min_id, eof marks the log as complete,
+        returns the id of the appended piece
+        """
+        stream_key = "{0}_{1}".format(CAPTURE_LOG_STREAM_PREFIX, job_id)
+
+        pipe = self.app.backend.client.pipeline(transaction=False)
+        if min_id is not None:
+            pipe.xtrim(stream_key, minid=min_id, approximate=False)
+        if data:
+            pipe.xadd(stream_key, {"data": data})
+        if eof:
+            pipe.xadd(stream_key, {"eof": 1})
+            pipe.expire(stream_key, CAPTURE_LOG_STREAM_EOF_TTL)
+        else:
+            pipe.expire(stream_key, JOB_STATE_TTL)
+        results = pipe.execute()
+
+        if data:
+            return results[0 if min_id is None else 1]
+
+    def read_capture_log_stream(self, job_id, last_id="0", block=None):
+        """
+        read a capture's live log after last_id, optionally blocking for up
+        to block milliseconds, returns last id read, data and whether the
+        log is complete
+        """
+        stream_key = "{0}_{1}".format(CAPTURE_LOG_STREAM_PREFIX, job_id)
+
+        response = self.app.backend.client.xread(
+            {stream_key: last_id}, block=block
+        )
+
+        data = []
+        eof = False
+        for _, entries in response:
+            for entry_id, fields in entries:
+                last_id = str(entry_id, self.app.backend.content_encoding)
+                if b"eof" in fields:
+                    eof = True
+                else:
+                    data.append(fields[b"data"])
+
+        return last_id, b"".join(data), eof
 
-    def mark_chunk_complete(self, channel, timestamp, chunk):
-        return self.app.backend.client.zadd(
+    def mark_chunk_complete(self, channel, timestamp, chunk, checksum=None):
+        """
+        checksum is the size and ETag of the uploaded chunk, if not
+        given any previously recorded checksum is kept
+        """
+        pipe = self.app.backend.client.pipeline()
+        pipe.zadd(
             "{0}-{1}".format(ARCHIVE_STATE_PREFIX, channel), {chunk: timestamp}
         )
+        if checksum is not None:
+            _, _, encoded_checksum = dumps(
+                checksum, serializer=self.app.backend.serializer
+            )
+            pipe.hset(
+                "{0}-{1}".format(ARCHIVE_CHECKSUM_PREFIX, channel),
+                chunk,
+                encoded_checksum,
+            )
+        return pipe.execute()[0]
+
+    def mark_chunk_missing(self, channel, chunk, forget_checksum=True):
+        """
+        actually just removes the chunk from the list, and its checksum unless
+        forget_checksum is False
+        """
+        pipe = self.app.backend.client.pipeline()
+        pipe.zrem("{0}-{1}".format(ARCHIVE_STATE_PREFIX, channel), chunk)
+        if forget_checksum:
+            pipe.hdel(
+                "{0}-{1}".format(ARCHIVE_CHECKSUM_PREFIX, channel), chunk
+            )
+        return pipe.execute()[0]
 
-    def mark_chunk_missing(self, channel, chunk):
+    def remove_chunks(self, channel, chunks):
         """
-        actually just removes the chunk from the list
+        remove chunks from the list, and their checksums
         """
-        return self.app.backend.client.zrem(
-            "{0}-{1}".format(ARCHIVE_STATE_PREFIX, channel), chunk
+        if not chunks:
+            return 0
+
+        pipe = self.app.backend.client.pipeline()
+        pipe.zrem("{0}-{1}".format(ARCHIVE_STATE_PREFIX, channel), *chunks)
+        pipe.hdel("{0}-{1}".format(ARCHIVE_CHECKSUM_PREFIX, channel), *chunks)
+        return pipe.execute()[0]
+
+    def get_chunk_checksums(self, channel):
+        """
+        get recorded checksums of a channel's chunks, by chunk name
+        """
+        checksums = self.app.backend.client.hgetall(
+            "{0}-{1}".format(ARCHIVE_CHECKSUM_PREFIX, channel)
         )
 
+        return {
+            str(chunk, self.app.backend.content_encoding): loads(
+                checksum,
+                content_type=self.app.backend.content_type,
+                content_encoding=self.app.backend.content_encoding,
+                accept=self.app.backend.accept,
+            )
+            for chunk, checksum in checksums.items()
+        }
+
     def get_complete_chunks(self, channel, start, end):
         """
         get complete chunks within given time range
@@ -0,0 +1,151 @@
+"""
+Compact versioned encoding of state stored in redis
+
+Values start with a format version byte, anything else is legacy kombu JSON.
+Jobs are stored as a msgpack array of their known fields in a fixed order,
+other state as a msgpack map. Datetimes are stored as msgpack timestamps and
+UUIDs as 16 bytes. Job times are only stored as timestamps, their ISO 8601
+form is built when decoding.
+"""
+from datetime import datetime, timezone
+from uuid import UUID
+import msgpack
+
+
+STATE_FORMAT = b"\x01"
+JOB_FORMAT = b"\x02"
+
+UUID_EXT = 1
+NAIVE_DATETIME_EXT = 2
+
+# known job fields in storage order, append only
+JOB_FIELDS = [
+    "id",
+    "channel_name",
+    "channel_url",
+    "start",
+    "end",
+    "s3_endpoint",
+    "s3_bucket",
+    "secure",
+    "s3_part_size",
+    "s3_parallel_uploads",
+    "stages",
+    "queue",
+    "queued_timestamp",
+    "predicted",
+    "start_time",  # no longer stored
+    "start_timestamp",
+    "chunk",
+    "capture_command",
+    "capture_file_path",
+    "capture_returncode",
+    "capture_log",
+    "chunk_checksum",
+    "complete_time",  # no longer stored
+    "complete_timestamp",
+]
+
+# never stored, the job's channel config has them
+JOB_SECRET_FIELDS = ["s3_access_key", "s3_secret_key"]
+
+# never stored, built from the timestamp they are the ISO 8601 form of
+JOB_TIME_FIELDS = {
+    "start_time": "start_timestamp",
+    "complete_time": "complete_timestamp",
+}
+
+
+def default(obj):
+    if isinstance(obj, UUID):
+        return msgpack.ExtType(UUID_EXT, obj.bytes)
+    if isinstance(obj, datetime):
+        # aware datetimes are packed as msgpack timestamps
+        return msgpack.ExtType(
+            NAIVE_DATETIME_EXT, obj.isoformat().encode("utf-8")
+        )
+    raise TypeError("can't encode {0!r}".format(obj))
+
+
+def ext_hook(code, data):
+    if code == UUID_EXT:
+        return UUID(bytes=data)
+    if code == NAIVE_DATETIME_EXT:
+        return datetime.fromisoformat(data.decode("utf-8"))
+    return msgpack.ExtType(code, data)
+
+
+def packb(obj):
+    return msgpack.packb(obj, default=default, datetime=True)
+
+
+def unpackb(data):
+    return msgpack.unpackb(data, ext_hook=ext_hook, timestamp=3)
+
+
+def pack_state(obj):
+    """
+    encode e.g. a channel config
+    """
+    return STATE_FORMAT + packb(obj)
+
+
+def pack_job(job):
+    """
+    encode a job, as a bitmap of which known fields are present, their
+    values, and a map of any other fields
+    """
+    present = 0
+    values = []
+    for i, field in enumerate(JOB_FIELDS):
+        if field in job and field not in JOB_TIME_FIELDS:
+            present |= 1 << i
+            value = job[field]
+            if field == "id" and isinstance(value, str):
+                try:
+                    value = UUID(value)
+                except ValueError:
+                    pass
+            values.append(value)
+
+    extra = {
+        field: value
+        for field, value in job.items()
+        if field not in JOB_FIELDS
+        and field not in JOB_SECRET_FIELDS
+        and field not in JOB_TIME_FIELDS
+    }
+
+    return JOB_FORMAT + packb([present, values, extra])
+
+
+def unpack(data, legacy_loads):
+    """
+    decode state encoded by pack_state or pack_job, data in any other format
+    is decoded with legacy_loads
+    """
+    if data is None:
+        return None
+
+    if data[:1] == STATE_FORMAT:
+        return unpackb(data[1:])
+
+    if data[:1] == JOB_FORMAT:
+        present, values, extra = unpackb(data[1:])
+        values = iter(values)
+        job = {
+            field: next(values)
+            for i, field in enumerate(JOB_FIELDS)
+            if present & (1 << i)
+        }
+        job.update(extra)
+        for field, timestamp_field in JOB_TIME_FIELDS.items():
+            if timestamp_field in job:
+                job[field] = (
+                    datetime.fromtimestamp(job[timestamp_field], timezone.utc)
+                    .replace(tzinfo=None)
+                    .isoformat()
+                )
+        return job
+
+    return legacy_loads(data)
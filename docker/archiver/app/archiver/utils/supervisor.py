@@ -0,0 +1,117 @@
+"""
+Asyncio supervisor for running many capture subprocesses from one worker
+"""
+import asyncio
+import os
+import queue
+import signal
+import threading
+
+
+def concurrency_limit(per_cpu, network_budget=0, bitrate=0):
+    """
+    derive how many captures can run at once from the number of CPUs and,
+    if given, the network budget and expected bitrate per capture in bits/s
+    """
+    limit = (os.cpu_count() or 1) * per_cpu
+    if network_budget > 0 and bitrate > 0:
+        limit = min(limit, network_budget // bitrate)
+    return max(1, int(limit))
+
+
+class CaptureSupervisor(object):
+    """
+    Runs subprocesses on an asyncio event loop in a background thread, so a
+    single worker process (e.g. using the threads pool) can supervise many
+    captures without blocking a process per capture. At most max_concurrent
+    run at once, the rest wait for a free slot.
+    """
+
+    def __init__(self, max_concurrent):
+        self.max_concurrent = max_concurrent
+        self.loop = None
+        self.semaphore = None
+        self.pid = None
+        self.processes = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        # the loop thread doesn't survive a fork, so start one per process
+        with self.lock:
+            if self.loop is None or self.pid != os.getpid():
+                self.loop = asyncio.new_event_loop()
+                self.semaphore = asyncio.Semaphore(self.max_concurrent)
+                self.processes = {}
+                self.pid = os.getpid()
+                threading.Thread(
+                    target=self.loop.run_forever, daemon=True
+                ).start()
+
+    async def forward_stderr(self, process, output):
+        while True:
+            data = await process.stderr.read(65536)
+            if not data:
+                break
+            output.put(data)
+        return await process.wait()
+
+    async def supervise(self, key, cmd, timeout, output):
+        async with self.semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            self.processes[key] = process
+            try:
+                return await asyncio.wait_for(
+                    self.forward_stderr(process, output), timeout
+                )
+            except asyncio.TimeoutError:
+                process.kill()
+                return await process.wait()
+            finally:
+                # also when cancelled or forwarding failed, as nothing can
+                # reach the process once it is dropped from processes
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                self.processes.pop(key, None)
+
+    def run(self, key, cmd, timeout, on_stderr):
+        """
+        run cmd under supervision, blocking only the calling thread, stderr
+        is passed to on_stderr on the calling thread as it is read, returns
+        returncode. Processes are killed after timeout seconds, or when the
+        calling thread is interrupted or on_stderr raises
+        """
+        self.start()
+
+        # stderr is handled on the calling thread, so a slow on_stderr never
+        # holds up the loop shared by all captures
+        output = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self.supervise(key, cmd, timeout, output), self.loop
+        )
+        future.add_done_callback(lambda _: output.put(None))
+        try:
+            for data in iter(output.get, None):
+                on_stderr(data)
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    def cancel(self, key):
+        """
+        kill a running process, returns False if there is none for key
+        """
+        process = self.processes.get(key)
+        if process is None:
+            return False
+        self.loop.call_soon_threadsafe(process.send_signal, signal.SIGKILL)
+        return True
+
+    def cancel_all(self):
+        for key in list(self.processes):
+            self.cancel(key)
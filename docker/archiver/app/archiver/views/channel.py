@@ -3,12 +3,18 @@ from datetime import datetime
 import isodate
 from archiver import archiver_api, state
 from archiver.tasks.archive import cleanup_archive, verify_archive
-from archiver.utils.archive import Archive
-from archiver.utils.flask_request_helpers import request_wants_json
+from archiver.utils.flask_request_helpers import (
+    request_wants_json,
+    timestamp_arg,
+)
 
 
 EPOCH = datetime(1970, 1, 1, tzinfo=isodate.tzinfo.UTC)
 
+# multipart upload part size limits of S3
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+
 
 @archiver_api.route("/channel/")
 def get_all_channels():
@@ -33,6 +39,10 @@ def get_all_channels():
                     type: string
                 s3_secret_key:
                     type: string
+                s3_part_size:
+                    type: integer
+                s3_parallel_uploads:
+                    type: integer
         channel_list:
             type: object
             properties:
@@ -133,6 +143,13 @@ def put_channel(channel_name):
                     success:
                         type: string
                         default: created new channel
+        400:
+            description: missing or invalid fields
+            schema:
+                type: object
+                properties:
+                    error:
+                        type: string
         415:
             description: wrong content type
             schema:
@@ -197,6 +214,23 @@ def put_channel(channel_name):
             ]
         }
 
+        # optional fields
+        for field, minimum, maximum in [
+            ("s3_part_size", S3_MIN_PART_SIZE, S3_MAX_PART_SIZE),
+            ("s3_parallel_uploads", 1, float("inf")),
+        ]:
+            if field in request_json:
+                value = request_json[field]
+                if (
+                    not isinstance(value, int)
+                    or isinstance(value, bool)
+                    or not minimum <= value <= maximum
+                ):
+                    return make_response(
+                        jsonify({"error": "invalid {0}".format(field)}), 400
+                    )
+                channel_config[field] = value
+
         set_channel = state.set_channel(channel_name, channel_config)
 
         if set_channel == 1:
@@ -263,6 +297,16 @@ def get_channel_archive(channel_name):
           description: channel name
           type: string
           required: true
+        - name: start
+          in: query
+          description: only chunks starting at or after this time (ISO 8601)
+          type: string
+          required: false
+        - name: end
+          in: query
+          description: only chunks starting at or before this time (ISO 8601)
+          type: string
+          required: false
     definitions:
         archive:
             type: array
@@ -273,21 +317,27 @@ def get_channel_archive(channel_name):
             description: Channel archive
             schema:
                 $ref: '#/definitions/archive'
+        400:
+            description: invalid start or end
     """
     channel = state.get_channel(channel_name)
 
     if channel is not None:
-        channel_archive = Archive(
+        try:
+            start = timestamp_arg(request, "start")
+            end = timestamp_arg(request, "end")
+        except ValueError:
+            return make_response(
+                jsonify({"error": "start and end must be ISO 8601"}), 400
+            )
+
+        # served from the chunk catalog kept in redis, not an S3 listing
+        chunks = state.get_complete_chunks(
             channel_name,
-            channel["s3_endpoint"],
-            channel["s3_access_key"],
-            channel["s3_secret_key"],
-            channel["s3_bucket"],
-            channel["secure"],
+            "-inf" if start is None else start,
+            "+inf" if end is None else end,
         )
 
-        chunks = channel_archive.list_chunks()
-
         if request_wants_json(request):
             response = make_response(jsonify(chunks))
         else:
@@ -327,17 +377,6 @@ def get_channel_archive_gaps(channel_name):
     channel = state.get_channel(channel_name)
 
     if channel is not None:
-        channel_archive = Archive(
-            channel_name,
-            channel["s3_endpoint"],
-            channel["s3_access_key"],
-            channel["s3_secret_key"],
-            channel["s3_bucket"],
-            channel["secure"],
-        )
-
-        chunks = channel_archive.list_chunks()
-
         gaps = []
 
         now = datetime.now(isodate.UTC)
@@ -348,6 +387,16 @@ def get_channel_archive_gaps(channel_name):
         start_interval = (start - EPOCH) // interval
         end_interval = (now - EPOCH) // interval
 
+        # served from the chunk catalog kept in redis, not an S3 listing,
+        # from the start of the first chunk checked which is before start
+        chunks = set(
+            state.get_complete_chunks(
+                channel_name,
+                (EPOCH + (start_interval * interval)).timestamp(),
+                now.timestamp(),
+            )
+        )
+
         for i in range(start_interval, end_interval):
             chunk_start = EPOCH + (i * interval)
             chunk_end = EPOCH + ((i + 1) * interval)
@@ -1,6 +1,28 @@
-from flask import jsonify, make_response, render_template, request
+from flask import (
+    jsonify,
+    make_response,
+    render_template,
+    request,
+    url_for,
+)
 from archiver import archiver_api, state
-from archiver.utils.flask_request_helpers import request_wants_json
+from archiver.utils.archive import Archive
+from archiver.utils.flask_request_helpers import (
+    request_wants_json,
+    timestamp_arg,
+)
+from archiver.utils.state_backend import JOB_STATUSES, job_status
+import re
+
+# how long a capture log stream request waits for new data, in milliseconds,
+# well within the API's worker timeout
+CAPTURE_LOG_STREAM_BLOCK = 5000
+
+# redis stream entry id
+STREAM_ID = re.compile(r"[0-9]+(-[0-9]+)?")
+
+# default and maximum number of jobs listed at once
+JOB_PAGE_SIZE = 1000
 
 
 @archiver_api.route("/job/")
@@ -48,6 +70,13 @@ def get_all_jobs():
                     type: string
                 capture_file_path:
                     type: string
+                chunk_checksum:
+                    type: object
+                    properties:
+                        size:
+                            type: integer
+                        etag:
+                            type: string
                 complete_time:
                     type: string
                 complete_timestamp:
@@ -59,13 +88,85 @@ def get_all_jobs():
                     type: array
                     items:
                         $ref: '#/definitions/job'
+    parameters:
+        - name: channel
+          in: query
+          description: only jobs of this channel
+          type: string
+          required: false
+        - name: status
+          in: query
+          description: only jobs with this status
+          type: string
+          enum: [running, deferred, rejected, failed, done]
+          required: false
+        - name: since
+          in: query
+          description: only jobs started at or after this time (ISO 8601)
+          type: string
+          required: false
+        - name: until
+          in: query
+          description: only jobs started at or before this time (ISO 8601)
+          type: string
+          required: false
+        - name: cursor
+          in: query
+          description: X-Next-Cursor header of the previous page
+          type: string
+          required: false
+        - name: limit
+          in: query
+          description: maximum number of jobs to return, at most 1000
+          type: integer
+          required: false
+          default: 1000
     responses:
         200:
-            description: List of jobs
+            description: List of jobs, newest first, if there are more the
+                X-Next-Cursor header has the cursor for the next page
             schema:
                 $ref: '#/definitions/job_list'
+        400:
+            description: invalid query parameters
     """
-    jobs = state.get_all_job_states()
+    status = request.args.get("status")
+    if status is not None and status not in JOB_STATUSES:
+        return make_response(jsonify({"error": "unknown status"}), 400)
+
+    try:
+        since = timestamp_arg(request, "since")
+        until = timestamp_arg(request, "until")
+    except ValueError:
+        return make_response(
+            jsonify({"error": "since and until must be ISO 8601"}), 400
+        )
+
+    # score and id of the last job of the previous page
+    cursor = request.args.get("cursor")
+    if cursor is not None:
+        score, _, id = cursor.partition(":")
+        try:
+            cursor = (float(score), id)
+        except ValueError:
+            return make_response(jsonify({"error": "invalid cursor"}), 400)
+
+    limit = request.args.get("limit", JOB_PAGE_SIZE, type=int)
+
+    # bounded page from the job indexes rather than every job of the past day
+    page, next_page_cursor = state.find_jobs(
+        channel=request.args.get("channel"),
+        status=status,
+        since=since,
+        until=until,
+        cursor=cursor,
+        limit=min(max(limit, 1), JOB_PAGE_SIZE),
+    )
+    jobs = dict(page)
+
+    next_cursor = None
+    if next_page_cursor is not None:
+        next_cursor = "{0!r}:{1}".format(*next_page_cursor)
 
     for name, job in jobs.items():
         if "s3_secret_key" in job:
@@ -80,7 +181,17 @@ def get_all_jobs():
     if request_wants_json(request):
         response = make_response(jsonify(jobs))
     else:
-        response = make_response(render_template("jobs.html", jobs=jobs))
+        next_page = None
+        if next_cursor is not None:
+            next_page = url_for(
+                ".get_all_jobs",
+                **dict(request.args.items(), cursor=next_cursor),
+            )
+        response = make_response(
+            render_template("jobs.html", jobs=jobs, next_page=next_page)
+        )
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
     return response, 200
 
 
@@ -131,12 +242,19 @@ def get_job_capture_log(job_id):
           description: job ID
           type: string
           required: true
+        - name: full
+          in: query
+          description: get the full log from S3 if one was stored there
+          type: boolean
+          required: false
     definitions:
         capture_log:
             type: object
             properties:
                 stderr:
                     type: string
+                location:
+                    type: string
     responses:
         200:
             description: capture_log
@@ -151,6 +269,26 @@ def get_job_capture_log(job_id):
         if "capture_log" in job:
             capture_log = state.get_capture_log(job["capture_log"])
 
+            # the capped log in redis is the default, the full log is
+            # optionally stored beside the chunk
+            if "location" in capture_log and request.args.get("full"):
+                channel = state.get_channel(job["channel_name"])
+
+                if channel is not None:
+                    channel_archive = Archive(
+                        job["channel_name"],
+                        channel["s3_endpoint"],
+                        channel["s3_access_key"],
+                        channel["s3_secret_key"],
+                        channel["s3_bucket"],
+                        channel["secure"],
+                    )
+                    capture_log["stderr"] = str(
+                        channel_archive.get_log(capture_log["location"]),
+                        "utf-8",
+                        "replace",
+                    )
+
             if request_wants_json(request):
                 return make_response(jsonify(capture_log), 200)
             else:
@@ -162,3 +300,69 @@ def get_job_capture_log(job_id):
             return make_response(jsonify({"error": "no capture logs"}), 404)
     else:
         return make_response(jsonify({"error": "job not found"}), 404)
+
+
+@archiver_api.route("/job/<job_id>/capture_log/stream")
+def stream_job_capture_log(job_id):
+    """
+    follow capture log of a running job by long polling, each response has
+    the log written after last_id, waiting a few seconds for more if there
+    is none yet
+    ---
+    parameters:
+        - name: job_id
+          in: path
+          description: job ID
+          type: string
+          required: true
+        - name: last_id
+          in: query
+          description: last_id of the previous response, to continue after it
+          type: string
+          required: false
+    definitions:
+        capture_log_stream:
+            type: object
+            properties:
+                log:
+                    type: string
+                last_id:
+                    type: string
+                complete:
+                    type: boolean
+    responses:
+        200:
+            description: capture log after last_id, complete once there will
+                be no more
+            schema:
+                $ref: '#/definitions/capture_log_stream'
+        400:
+            description: invalid last_id
+        404:
+            description: job not found
+    """
+    last_id = request.args.get("last_id", "0")
+    if not STREAM_ID.fullmatch(last_id):
+        return make_response(jsonify({"error": "invalid last_id"}), 400)
+
+    job = state.get_job_state(job_id)
+    if job is None:
+        return make_response(jsonify({"error": "job not found"}), 404)
+
+    last_id, data, eof = state.read_capture_log_stream(
+        job_id, last_id, CAPTURE_LOG_STREAM_BLOCK
+    )
+
+    # jobs which aren't running won't log any more, e.g. rejected, deferred
+    # or finished without a live log
+    complete = eof or (not data and job_status(job) != "running")
+
+    return make_response(
+        jsonify(
+            {
+                "log": str(data, "utf-8", "replace"),
+                "last_id": last_id,
+                "complete": complete,
+            }
+        )
+    )
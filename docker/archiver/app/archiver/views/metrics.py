@@ -0,0 +1,19 @@
+from flask import make_response
+from archiver import archiver_api
+from archiver.utils import metrics
+
+
+@archiver_api.route("/metrics")
+def get_metrics():
+    """
+    Prometheus metrics
+    ---
+    responses:
+        200:
+            description: metrics in Prometheus text format
+    """
+    data, content_type = metrics.latest()
+
+    response = make_response(data, 200)
+    response.headers["Content-Type"] = content_type
+    return response